@@ -0,0 +1,281 @@
+#!/bin/python3
+"""Benchmarks for searchgenerator
+
+Run `python benchmarks.py` from the repository root. Exits non-zero when a
+guarded benchmark regresses past its limit.
+
+The suite times the generation hot paths over synthetic inputs. Save its
+timings with --save-baseline, then pass --baseline on later runs (on the same
+machine) to fail when anything gets slower than --threshold allows.
+"""
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+import typing
+from urllib.parse import quote_plus
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Runs in a fresh interpreter: reports how long `import main` took and whether it pulled in ruamel
+IMPORT_PROBE = """
+import sys, time
+start = time.perf_counter()
+import main
+elapsed = time.perf_counter() - start
+print(elapsed, 'ruamel' in sys.modules)
+"""
+
+
+def benchImport(repeat: int = 7) -> dict[str, typing.Any]:
+    """Median wall time of importing main as a library, in a fresh interpreter each time"""
+    env = {k: v for k, v in os.environ.items() if k != 'PYTHONDONTWRITEBYTECODE'}
+    timings: list[float] = []
+    imports_yaml = False
+    # The first run is a warmup that also writes the bytecode cache
+    for _ in range(repeat + 1):
+        out = subprocess.run(
+            [sys.executable, "-c", IMPORT_PROBE],
+            cwd=HERE, env=env, check=True, capture_output=True, text=True
+        ).stdout.split()
+        timings.append(float(out[0]))
+        imports_yaml = imports_yaml or out[1] == 'True'
+    return {
+        'seconds': statistics.median(timings[1:]),
+        'imports_yaml': imports_yaml
+    }
+
+
+def _quotedPlans() -> list:
+    """Plans over the AO3 example input"""
+    import main
+    loaded = main.loadInput(os.path.join(HERE, "input_example_ao3.json"))
+    return [
+        main.Pattern(k, v, loaded.input_categories, loaded.default_predicate).compile()
+        for pattern in loaded.patterns for k, v in pattern.items()
+    ]
+
+
+def benchQuoted(n: int = 100_000) -> dict[str, float]:
+    """Seconds to URL-encode n random queries by quote_plus versus by joining pre-encoded fragments"""
+    import main
+    plan = max(_quotedPlans(), key=lambda p: len(p.slot_categories))
+    rng = main.spawnRandom(0)
+    picks = [plan.drawPicks(rng) for _ in range(n)]
+    start = time.perf_counter()
+    for p in picks:
+        quote_plus(plan.render(plan.picksFragments(p)))
+    whole = time.perf_counter() - start
+    start = time.perf_counter()
+    for p in picks:
+        plan.render(plan.picksFragments(p, quoted=True), quoted=True)
+    joined = time.perf_counter() - start
+    return {'quote_plus': whole, 'joined': joined}
+
+
+def benchCss(tags: int = 100_000) -> dict[str, float]:
+    """Seconds to write highlight.css for a number of unique tags, and again with each tag repeated"""
+    import io
+    import main
+    values = [f"Tag {i} / Sub.tag & Co?" for i in range(tags)]
+    timings: dict[str, float] = {}
+    for name, highlights in [
+        ('unique', {'yellow': values}),
+        # Same tags in a second color: twice the selectors, but no new tags to encode
+        ('repeated', {'yellow': values, 'blue': values}),
+    ]:
+        main.ao3TagHref.cache_clear()
+        start = time.perf_counter()
+        main.writeCss(io.StringIO(), highlights)
+        timings[name] = time.perf_counter() - start
+    return timings
+
+
+# Tag counts of the synthetic inputs, and the queries each generation benchmark produces
+SUITE_SIZES: tuple[int, ...] = (10, 1_000, 100_000)
+SUITE_QUERIES: int = 10_000
+# nth decodes each index from scratch, in time linear in the narrowers, so enumerate fewer
+SUITE_STREAM: int = 1_000
+
+# Options per narrower in the synthetic inputs; AO3 ORs each narrower's options into one predicate
+SUITE_OPTIONS: int = 5
+
+# Pattern trees: a flat AND of two leaves, and alternating AND/OR nested five levels deep
+SUITE_SHAPES: dict[str, dict] = {
+    'shallow': {'AND': ['fandom', 'theme']},
+    'deep': {'AND': ['fandom', {'OR': ['theme', {'AND': ['fandom', {'OR': ['theme', {'AND': ['fandom', 'theme']}]}]}]}]},
+}
+
+
+def syntheticInput(tags: int, shape: str) -> dict[str, typing.Any]:
+    """A declarative AO3 input with about the given number of unique tags, split between fandom and theme"""
+    # Enough narrowers that every leaf of the deep pattern can draw a distinct one
+    narrowers = max(4, tags // (2 * SUITE_OPTIONS))
+    options = max(1, tags // (2 * narrowers))
+    request: dict[str, typing.Any] = {'dialect': 'ao3', 'patterns': [SUITE_SHAPES[shape]]}
+    for category in ('fandom', 'theme'):
+        request[category] = {
+            f"{category}{n}": [f"{category.title()} {n}.{o}" for o in range(options)]
+            for n in range(narrowers)
+        }
+    return request
+
+
+def _timed(run: typing.Callable[[], typing.Any], repeat: int) -> float:
+    """Best seconds per call of run, batching fast calls so each timing takes at least 0.2s
+
+    The minimum is the least disturbed by other load on the machine.
+    """
+    import timeit
+    timer = timeit.Timer(run)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat, number)) / number
+
+
+def runSuite(sizes: typing.Iterable[int] = SUITE_SIZES, repeat: int = 3) -> dict[str, float]:
+    """Best seconds of every suite benchmark, keyed like 'random/1000/deep'"""
+    import io
+    import tempfile
+    import main
+
+    results: dict[str, float] = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in sizes:
+            for shape in SUITE_SHAPES:
+                path = os.path.join(tmp, f"synthetic_{size}_{shape}.json")
+                with open(path, "w", encoding="utf-8") as fp:
+                    json.dump(syntheticInput(size, shape), fp)
+
+                # Loading doesn't depend on the pattern, so only time it once per size
+                if shape == 'shallow':
+                    results[f"load/{size}"] = _timed(lambda: main.readInput(path), repeat)
+
+                    # The same input as YAML, parsed and then through a warm pickle cache
+                    yaml_path = os.path.join(tmp, f"synthetic_{size}.yaml")
+                    cache_path = os.path.join(tmp, f"synthetic_{size}.cache")
+                    main.writeSynth(yaml_path, main.readInput(path))
+                    results[f"load_yaml/{size}"] = _timed(lambda: main.readInput(yaml_path), repeat)
+                    main.loadInput(yaml_path, cache_path)
+                    results[f"load_yaml_cached/{size}"] = _timed(lambda: main.loadInput(yaml_path, cache_path), repeat)
+
+                loaded = main.loadInput(path)
+                patterns = [
+                    main.Pattern(k, v, loaded.input_categories, loaded.default_predicate)
+                    for pattern in loaded.patterns for k, v in pattern.items()
+                ]
+                results[f"compile/{size}/{shape}"] = _timed(lambda: [p.compile() for p in patterns], repeat)
+                plans = [[p.compile() for p in patterns]]
+                plan = plans[0][0]
+
+                results[f"random/{size}/{shape}"] = _timed(
+                    lambda: main.generateChunk(plans, 0, 0, SUITE_QUERIES), repeat)
+
+                def _stream() -> None:
+                    for index in range(min(SUITE_STREAM, plan.count())):
+                        plan.nth(index)
+                results[f"stream/{size}/{shape}"] = _timed(_stream, repeat)
+
+                picks = [plan.drawPicks(main.spawnRandom(0, i)) for i in range(SUITE_QUERIES)]
+
+                def _format() -> None:
+                    for p in picks:
+                        plan.picksPredicate(p).format()
+                results[f"format/{size}/{shape}"] = _timed(_format, repeat)
+
+                def _urls() -> None:
+                    for p in picks:
+                        main.searchUrl(loaded.bag_kind, plan.render(plan.picksFragments(p)),
+                                       plan.render(plan.picksFragments(p, quoted=True), quoted=True))
+                results[f"url/{size}/{shape}"] = _timed(_urls, repeat)
+
+                if shape == 'shallow':
+                    def _css() -> None:
+                        main.ao3TagHref.cache_clear()
+                        main.writeCss(io.StringIO(), main.highlightTags(loaded.input_categories))
+                    results[f"css/{size}"] = _timed(_css, repeat)
+    return results
+
+
+def compareBaseline(results: dict[str, float], baseline: dict[str, float], threshold: float) -> list[str]:
+    """Names of the benchmarks more than threshold (a fraction) slower than their baseline"""
+    return [
+        name for name, seconds in results.items()
+        if name in baseline and seconds > baseline[name] * (1 + threshold)
+    ]
+
+
+def parse_args():
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="Benchmark searchgenerator",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+
+    parser.add_argument("--repeat", type=int, default=7)
+    parser.add_argument("--max-import-ms", type=float, default=100,
+                        help="Fail if importing main takes longer than this")
+    parser.add_argument("--sizes", type=lambda s: [int(n) for n in s.split(",")], default=list(SUITE_SIZES),
+                        help="Comma-separated tag counts of the suite's synthetic inputs")
+    parser.add_argument("--suite-repeat", type=int, default=3,
+                        help="Runs of each suite benchmark; the fastest is reported")
+    parser.add_argument("--no-suite", action="store_true",
+                        help="Only run the import and correctness checks")
+    parser.add_argument("--baseline", default=None, metavar="PATH",
+                        help="Fail if a suite benchmark is slower than in this saved baseline")
+    parser.add_argument("--threshold", type=float, default=0.25,
+                        help="With --baseline, the slowdown tolerated, as a fraction")
+    parser.add_argument("--save-baseline", default=None, metavar="PATH",
+                        help="Write the suite's timings to PATH as a baseline")
+
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    failed = False
+
+    result = benchImport(args.repeat)
+    print(f"import main: {result['seconds'] * 1000:.1f} ms")
+    if result['imports_yaml']:
+        print("  FAIL: importing main imported ruamel.yaml")
+        failed = True
+    if result['seconds'] * 1000 > args.max_import_ms:
+        print(f"  FAIL: slower than {args.max_import_ms} ms")
+        failed = True
+
+    result = benchQuoted()
+    print(f"URL-encode 100k queries: quote_plus {result['quote_plus'] * 1000:.1f} ms, "
+          f"pre-encoded {result['joined'] * 1000:.1f} ms")
+
+    result = benchCss()
+    print(f"highlight.css for 100k tags: {result['unique'] * 1000:.1f} ms, "
+          f"in two colors {result['repeated'] * 1000:.1f} ms")
+
+    if not args.no_suite:
+        results = runSuite(args.sizes, args.suite_repeat)
+        baseline = None
+        if args.baseline:
+            with open(args.baseline, encoding="utf-8") as fp:
+                baseline = json.load(fp)
+        width = max(map(len, results))
+        for name, seconds in results.items():
+            line = f"{name:<{width}} {seconds * 1000:10.2f} ms"
+            if baseline and name in baseline:
+                line += f"  ({seconds / baseline[name] - 1:+.0%} vs baseline)"
+            print(line)
+        if baseline:
+            for name in compareBaseline(results, baseline, args.threshold):
+                print(f"  FAIL: {name} is more than {args.threshold:.0%} slower than the baseline")
+                failed = True
+        if args.save_baseline:
+            with open(args.save_baseline, "w", encoding="utf-8") as fp:
+                json.dump(results, fp, indent=2)
+                fp.write("\n")
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
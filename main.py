@@ -1,29 +1,146 @@
 #!/bin/python3
-import ruamel.yaml
 import random
+import io
 import itertools
 import functools
+import hashlib
+import collections
+import contextlib
+import re
+import math
+import os
+import pickle
 import sys
 import typing
 from urllib.parse import urlencode, quote_plus, quote
 
-yaml = ruamel.yaml.YAML(typ='unsafe')
+
+# ruamel.yaml is only imported once something is actually parsed or dumped,
+# so using the predicate classes as a library stays cheap to import.
+@functools.cache
+def getYaml() -> 'ruamel.yaml.YAML':
+    import ruamel.yaml
+    return ruamel.yaml.YAML(typ='unsafe')
+
+
+@functools.cache
+def getStreamYaml() -> 'ruamel.yaml.YAML':
+    """The pure-Python parser exposes the event and compose API readInput streams through"""
+    import ruamel.yaml
+    return ruamel.yaml.YAML(typ='unsafe', pure=True)
+
+
+def __getattr__(name: str) -> typing.Any:
+    # Keep the old module-level `yaml` object working for library callers
+    if name == 'yaml':
+        return getYaml()
+    raise AttributeError(name)
+
 
 debug_output = False
 
 
+def _memoizedFormat(format: typing.Callable[[typing.Any], str]) -> typing.Callable[[typing.Any], str]:
+    """Cache the rendering of frozen predicates
+
+    Only the most-derived format() caches, so super().format() calls pass straight through.
+    A cached string is discarded when one of the predicate's _format_attrs is reassigned,
+    or when a child it was rendered from has since been re-rendered.
+    """
+    @functools.wraps(format)
+    def wrapper(self) -> str:
+        if not self._frozen or type(self).format is not wrapper:
+            return format(self)
+        cached = self._format_cache
+        if cached is None or not self._formatFresh(cached[1]):
+            cached = (format(self), self._formatDependencies())
+            object.__setattr__(self, '_format_cache', cached)
+        return cached[0]
+    return wrapper
+
+
 class BasePredicate():
     """A condition, like a host, tag, or rating"""
 
+    # Vocabularies can hold hundreds of thousands of predicates, so none of them carry a __dict__
+    __slots__ = ('value', '_frozen', '_format_cache')
+
     VT: typing.TypeAlias = str  # typing.TypeVar('VT')
 
+    # Attributes format() reads; reassigning one discards this predicate's memoized format
+    _format_attrs: typing.ClassVar[tuple[str, ...]] = ('value',)
+
+    def __new__(cls, *args, **kwargs):
+        # Also runs when YAML or pickle restore an instance without calling __init__
+        self = super().__new__(cls)
+        object.__setattr__(self, '_frozen', False)
+        object.__setattr__(self, '_format_cache', None)
+        return self
+
     def __init__(self, value: VT) -> None:
         super().__init__()
         self.value: BasePredicate.VT = value
 
+    def __setattr__(self, name: str, value: typing.Any) -> None:
+        if name in self._format_attrs:
+            object.__setattr__(self, '_format_cache', None)
+        super().__setattr__(name, value)
+
+    def __getstate__(self) -> dict:
+        # Public slots only: don't serialize the frozen flag or caches
+        return {
+            name: getattr(self, name)
+            for cls in type(self).__mro__
+            for name in cls.__dict__.get('__slots__', ())
+            if not name.startswith('_') and hasattr(self, name)
+        }
+
+    def __setstate__(self, state: dict) -> None:
+        for name, value in state.items():
+            setattr(self, name, value)
+
+    def freeze(self) -> 'BasePredicate':
+        """Opt in to memoized formatting and value-based hashing. The value shouldn't change afterwards."""
+        self._frozen = True
+        return self
+
+    def _formatDependencies(self) -> tuple:
+        """The memoized formats of other predicates that this one's format was built from"""
+        return ()
+
+    def _formatFresh(self, dependencies: tuple) -> bool:
+        """Whether a format built from these dependencies is still current"""
+        return True
+
+    def _identity(self) -> tuple:
+        return (type(self), self.value)
+
+    def __eq__(self, other: object) -> bool:
+        if self._frozen and isinstance(other, BasePredicate) and other._frozen:
+            return self._identity() == other._identity()
+        return self is other
+
+    def __hash__(self) -> int:
+        if self._frozen:
+            return hash(self._identity())
+        return object.__hash__(self)
+
     def all_predicates(self) -> 'typing.Iterable[BasePredicate]':
         yield self
 
+    def canonical(self) -> 'BasePredicate':
+        """An equivalent predicate in normal form. Leaves already are."""
+        return self
+
+    def canonicalKey(self) -> str:
+        """A string identifying this predicate's structure, independent of formatting"""
+        return f"{type(self).__name__}:{self.value!r}"
+
+    def fingerprint(self) -> int:
+        """A stable 64-bit hash of the canonical form, equal for semantically equal trees"""
+        return fingerprintKey(self.canonical().canonicalKey())
+
+    @_memoizedFormat
     def format(self) -> str:
         return str(self.value)
 
@@ -36,6 +153,8 @@ PredicateOrTagstr: typing.TypeAlias = typing.Union[BasePredicate, str]
 
 
 class TagPredicate(BasePredicate):
+    __slots__ = ()
+
     def formatBinOp(self, taglist, op):
         if op == "AND":
             return " ".join(
@@ -47,8 +166,11 @@ class TagPredicate(BasePredicate):
 
 
 class TagPredicateAO3(BasePredicate):
+    __slots__ = ()
+
     key = 'tag'
 
+    @_memoizedFormat
     def format(self) -> str:
         return f'{self.key}:"{self.value}"'
 
@@ -60,69 +182,149 @@ class TagPredicateAO3(BasePredicate):
 
 
 class NotPredicateAO3(TagPredicateAO3):
+    __slots__ = ()
+
+    @_memoizedFormat
     def format(self) -> str:
         return f'NOT {super().format()}'
 
 
 class KVPredicateAO3(TagPredicateAO3):
+    __slots__ = ('key',)
+
+    _format_attrs = ('value', 'key')
+
     def __init__(self, value, key) -> None:
         self.key: str = key
         self.value: BasePredicate.VT = value
 
+    def _identity(self) -> tuple:
+        return (type(self), self.key, self.value)
+
+    def canonicalKey(self) -> str:
+        return f"{type(self).__name__}:{self.key!r}:{self.value!r}"
 
 
 class SitePredicate(TagPredicate):
+    __slots__ = ()
+
+    @_memoizedFormat
     def format(self):
         return "SITE:" + self.value
 
 
 class PredicateContainer(BasePredicate):
+    __slots__ = ('default_constructor', '_children')
+
+    def __new__(cls, *args, **kwargs):
+        self = super().__new__(cls, *args, **kwargs)
+        object.__setattr__(self, '_children', None)
+        return self
+
     def __init__(self, value: typing.Iterable[PredicateOrTagstr], default_constructor) -> None:
         super().__init__(value)  # type: ignore[arg-type]
         self.default_constructor: typing.Callable[[str], BasePredicate] = default_constructor
 
+    _format_attrs = ('value', 'default_constructor')
+
+    def __setattr__(self, name: str, value: typing.Any) -> None:
+        if name in self._format_attrs:
+            object.__setattr__(self, '_children', None)
+        super().__setattr__(name, value)
+
+    @property
+    def children(self) -> tuple[BasePredicate, ...]:
+        """The child predicates, with tag strings resolved once through default_constructor"""
+        children = self._children
+        if children is None:
+            children = tuple(
+                self.default_constructor(tag)
+                if isinstance(tag, str)
+                else tag
+                for tag in self.value
+            )
+            object.__setattr__(self, '_children', children)
+        return children
+
     def all_predicates(self) -> Predicates:
-        yield from (
-            self.default_constructor(tag)
-            if isinstance(tag, str)
-            else tag
-            for tag in self.value
+        return iter(self.children)
+
+    def _formatDependencies(self) -> tuple:
+        for child in self.children:
+            child.format()  # formatBinOp doesn't always go through a child's own format()
+        return tuple(child._format_cache for child in self.children)
+
+    def _formatFresh(self, dependencies: tuple) -> bool:
+        # A child that isn't caching can't vouch for its text, so neither can this
+        return all(
+            cached is not None and child._format_cache is cached and child._formatFresh(cached[1])
+            for child, cached in zip(self.children, dependencies)
         )
 
+    def freeze(self) -> 'PredicateContainer':
+        for tag in self.children:
+            tag.freeze()
+        return super().freeze()  # type: ignore[return-value]
+
+    def _identity(self) -> tuple:
+        return (type(self), tuple(self.value), self.default_constructor)
+
 
 class MultiAndPredicate(PredicateContainer):
+    __slots__ = ()
+
     op = 'AND'
 
     def __repr__(self) -> str:
         return f"<{type(self).__name__} {self.value!r}>"
 
+    @_memoizedFormat
     def format(self):
-        taglist = [*self.all_predicates()]
-        fallthrough = [*self.all_predicates()][0]
+        taglist = self.children
 
         if len(taglist) > 1:
-            # print(self.__class__.__name__, 'format', fallthrough.__class__, taglist)
-            first, *tail = taglist
-            res = fallthrough.__class__.formatBinOp(first, tail, self.op)
-            # print(self.__class__.__name__, 'format resolved', repr(res))
-            return res
+            first, tail = taglist[0], taglist[1:]
+            return first.__class__.formatBinOp(first, tail, self.op)
         else:
             return taglist[0].format()
 
     def formatBinOp(self, taglist, op):
-        fallthrough = [*self.all_predicates()][0]
+        fallthrough = self.children[0]
 
         if len(taglist) > 0:
-            # print(self.__class__.__name__, 'formatBinOp fallthrough', op, fallthrough.__class__, taglist)
-            res = fallthrough.__class__.formatBinOp(self, taglist, op)
-            # print(self.__class__.__name__, 'formatBinOp resolved', repr(res))
-            return res
+            return fallthrough.__class__.formatBinOp(self, taglist, op)
         else:
-            # print(self.__class__.__name__, 'formatBinOp lone', taglist[0])
             return self.format()
 
+    def canonical(self) -> BasePredicate:
+        """Flatten nested containers of the same op, drop duplicate children and sort the rest
+
+        AND and OR are commutative and idempotent, so the result means the same thing.
+        """
+        children: dict[str, BasePredicate] = {}
+        for child in self.children:
+            child = child.canonical()
+            if isinstance(child, MultiAndPredicate) and child.op == self.op:
+                flattened: typing.Iterable[BasePredicate] = child.children
+            else:
+                flattened = (child,)
+            for grandchild in flattened:
+                children.setdefault(grandchild.canonicalKey(), grandchild)
+        if len(children) == 1:
+            return next(iter(children.values()))
+        return type(self)([children[key] for key in sorted(children)], self.default_constructor)
+
+    def canonicalKey(self) -> str:
+        return f"{self.op}(" + ",".join(child.canonicalKey() for child in self.children) + ")"
+
+
+def fingerprintKey(key: str) -> int:
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'big')
+
 
 class MultiOrPredicate(MultiAndPredicate):
+    __slots__ = ()
+
     op = 'OR'
 
 
@@ -158,6 +360,41 @@ class Narrower():
     def getPredicateOpts(self) -> Predicates:
         yield from self.predicate_opts
 
+    def freeze(self) -> None:
+        for predicate in self.predicate_opts:
+            predicate.freeze()
+
+
+class SamplingPool():
+    """Items drawn uniformly without replacement in O(1), until reset()
+
+    Drawn items are swapped behind the live prefix of the list, so reset() is
+    also O(1): it just makes the whole list live again.
+    """
+
+    def __init__(self, items: typing.Iterable) -> None:
+        super().__init__()
+        self.items: list = list(items)
+        self.size: int = len(self.items)
+
+    def __repr__(self) -> str:
+        return f"<{type(self).__name__} {self.size}/{len(self.items)}>"
+
+    def __len__(self) -> int:
+        return self.size
+
+    def draw(self, rng: typing.Optional[random.Random] = None) -> typing.Any:
+        if self.size == 0:
+            raise IndexError("No new possibilities to draw")
+        items = self.items
+        i = (rng or random).randrange(self.size)
+        self.size -= 1
+        items[i], items[self.size] = items[self.size], items[i]
+        return items[self.size]
+
+    def reset(self) -> None:
+        self.size = len(self.items)
+
 
 class PredicateBag():
     """A collection of predicates"""
@@ -166,18 +403,39 @@ class PredicateBag():
     def __init__(self) -> None:
         super().__init__()
         self.narrowers: list[Narrower] = []
+        self._chosen: set[Narrower] = set()
+        # Sampling pools for categories passed to addRandom, keyed by the category list's id
+        self._pools: dict[int, tuple[typing.Sequence[Narrower], SamplingPool]] = {}
 
     def addNarrower(self, n: Narrower) -> None:
         self.narrowers.append(n)
+        self._chosen.add(n)
+
+    def _pool(self, ns: typing.Iterable[Narrower]) -> SamplingPool:
+        if not isinstance(ns, (list, tuple)):
+            return SamplingPool(dict.fromkeys(ns))
+        cached = self._pools.get(id(ns))
+        if cached is None or cached[0] is not ns:
+            cached = (ns, SamplingPool(dict.fromkeys(ns)))
+            self._pools[id(ns)] = cached
+        return cached[1]
+
+    def addRandom(self, ns: typing.Iterable[Narrower], rng: typing.Optional[random.Random] = None) -> None:
+        """Add a narrower from ns that isn't in the bag yet, in O(1) amortized per call"""
+        pool = self._pool(ns)
+        while len(pool) > 0:
+            choice = pool.draw(rng)
+            if choice not in self._chosen:
+                self.addNarrower(choice)
+                return
+        raise IndexError("No new possibilities to add", set(self.narrowers), set(pool.items))
 
-    def addRandom(self, ns: typing.Iterable[Narrower]) -> None:
-        ours: set[Narrower] = set(self.narrowers)
-        newopts: set[Narrower] = set(ns)
-        try:
-            choice = random.choice(list(newopts - ours))
-            self.addNarrower(choice)
-        except IndexError as e:
-            raise IndexError("No new possibilities to add", ours, newopts) from e
+    def clear(self) -> None:
+        """Empty the bag so it can be refilled with addRandom"""
+        self.narrowers = []
+        self._chosen = set()
+        for _, pool in self._pools.values():
+            pool.reset()
 
     @property
     def all_predicate_sets(self) -> typing.Iterable[Predicates]:
@@ -187,41 +445,1510 @@ class PredicateBag():
     def __repr__(self) -> str:
         return f"<{type(self).__name__} {[repr(n) for n in self.narrowers]}>"
 
-    def formatRandom(self) -> str:
+    def formatRandom(self, rng: typing.Optional[random.Random] = None) -> str:
         permutation = [
-            random.choice([*predicates_set]).format()
+            (rng or random).choice([*predicates_set]).format()
             for predicates_set
             in self.all_predicate_sets
         ]
         return MultiAndPredicate(permutation, self.default_constructor).format()
 
+    def iterAll(self, start: int = 0, stop: typing.Optional[int] = None) -> typing.Iterator[str]:
+        """Lazily yield every query, from the start-th combination up to (not including) stop"""
+        combinations = _productFrom(self.all_predicate_sets, start)
+        if stop is not None:
+            combinations = itertools.islice(combinations, max(0, stop - start))
+        for andlist in combinations:
+            yield MultiAndPredicate(andlist, self.default_constructor).format()
+
     def formatAll(self) -> typing.Iterable[str]:
-        return [
-            MultiAndPredicate(andlist, self.default_constructor).format()
-            for andlist in
-            itertools.product(*self.all_predicate_sets)
-        ]
+        return [*self.iterAll()]
+
+    def count(self) -> int:
+        """The number of queries iterAll would produce, without producing them"""
+        return math.prod(len(n.predicate_opts) for n in self.narrowers)
+
+    def nth(self, index: int) -> str:
+        """The index-th query of iterAll, decoded directly from the index"""
+        pools = [n.predicate_opts for n in self.narrowers]
+        digits = _mixedRadix(index, [len(pool) for pool in pools])
+        return MultiAndPredicate(
+            [pool[d] for pool, d in zip(pools, digits)],
+            self.default_constructor
+        ).format()
 
 
 class PredicateBagAO3(PredicateBag):
     default_constructor: typing.Type[BasePredicate] = TagPredicateAO3
 
-    def formatAll(self) -> typing.Iterable[str]:
+    def iterAll(self, start: int = 0, stop: typing.Optional[int] = None) -> typing.Iterator[str]:
+        # All options are ORed together, so there is only ever one query.
         andlist: list[MultiOrPredicate] = [
             MultiOrPredicate([*n.getPredicateOpts()], self.default_constructor)
             for n in self.narrowers
         ]
+        if start <= 0 and (stop is None or stop > 0):
+            yield MultiAndPredicate(andlist, self.default_constructor).format()[1:-1]
+
+    def count(self) -> int:
+        return 1
+
+    def nth(self, index: int) -> str:
+        if index != 0:
+            raise IndexError(index)
+        return next(self.iterAll())
+
+
+def _mixedRadix(index: int, radices: typing.Sequence[int]) -> list[int]:
+    """Decode index into one digit per radix, the last radix varying fastest"""
+    if index < 0:
+        raise IndexError(index)
+    digits: list[int] = []
+    for radix in reversed(radices):
+        if radix == 0:
+            raise IndexError(index)
+        index, digit = divmod(index, radix)
+        digits.append(digit)
+    if index:
+        raise IndexError("Index past the end of the space")
+    digits.reverse()
+    return digits
+
+
+def _productFrom(pools: typing.Iterable[typing.Iterable], start: int = 0) -> typing.Iterator[tuple]:
+    """Like itertools.product, but begins at the start-th combination without visiting the prefix"""
+    pools = [tuple(pool) for pool in pools]
+    try:
+        digits = _mixedRadix(start, [len(pool) for pool in pools])
+    except IndexError:
+        return
+
+    while True:
+        yield tuple(pool[d] for pool, d in zip(pools, digits))
+        for j in reversed(range(len(pools))):
+            digits[j] += 1
+            if digits[j] < len(pools[j]):
+                break
+            digits[j] = 0
+        else:
+            return
+
+
+def spawnRandom(seed: int, *path: typing.Hashable) -> random.Random:
+    """An independent random stream derived from seed and a path, e.g. (worker number,)
+
+    Streams are addressed rather than consumed from a parent, so any process can
+    recreate the stream for any path without coordination.
+    """
+    digest = hashlib.sha256(repr((seed, *path)).encode()).digest()
+    return random.Random(int.from_bytes(digest, 'big'))
+
+
+def spawnRandoms(seed: int, n: int) -> list[random.Random]:
+    """n independent substreams of seed, like SeedSequence.spawn"""
+    return [spawnRandom(seed, i) for i in range(n)]
+
+
+def _arrangements(weights: typing.Sequence[int], m: int) -> int:
+    """Ways to fill m ordered slots with distinct items, where item i offers weights[i] options"""
+    if m > len(weights):
+        return 0
+    if len(set(weights)) <= 1:
+        w = weights[0] if weights else 1
+        return math.perm(len(weights), m) * w ** m
+    # m! times the m-th elementary symmetric polynomial of the weights
+    e = [1] + [0] * m
+    for w in weights:
+        for k in range(m, 0, -1):
+            e[k] += e[k - 1] * w
+    return math.factorial(m) * e[m]
+
+
+def _countLeaves(leaves: typing.Sequence[str], weights: dict[str, list[int]]) -> int:
+    """The number of ways to fill leaves with distinct narrowers of their categories"""
+    return math.prod(
+        _arrangements(weights[category], m)
+        for category, m in collections.Counter(leaves).items()
+    )
+
+
+def _decodeLeaves(index: int, leaves: typing.Sequence[str], weights: dict[str, list[int]]) -> list[tuple[int, int]]:
+    """Decode index into a (narrower position, option) pair per leaf
+
+    Leaves vary lexicographically: the first leaf is the most significant.
+    """
+    if index < 0:
+        raise IndexError(index)
+    remaining = collections.Counter(leaves)
+    available = {c: list(range(len(weights[c]))) for c in remaining}
+    factors = {c: _arrangements(weights[c], remaining[c]) for c in remaining}
+    if index >= math.prod(factors.values()):
+        raise IndexError(index)
+
+    picks: list[tuple[int, int]] = []
+    for category in leaves:
+        remaining[category] -= 1
+        others = math.prod(f for c, f in factors.items() if c != category)
+        pool = available[category]
+        pool_weights = [weights[category][i] for i in pool]
+
+        if len(set(pool_weights)) == 1:
+            # Every narrower spans the same number of completions, so jump straight to it
+            per_option = others * _arrangements(pool_weights[1:], remaining[category])
+            position, index = divmod(index, pool_weights[0] * per_option)
+        else:
+            for position, w in enumerate(pool_weights):
+                per_option = others * _arrangements(pool_weights[:position] + pool_weights[position + 1:], remaining[category])
+                if index < w * per_option:
+                    break
+                index -= w * per_option
+
+        choice, index = divmod(index, per_option)
+        picks.append((pool[position], choice))
+        available[category] = pool[:position] + pool[position + 1:]
+        factors[category] = _arrangements([weights[category][i] for i in available[category]], remaining[category])
+    return picks
+
+
+class Pattern():
+    """An AND/OR tree over category names, bound to the loaded categories
+
+    Every leaf draws a distinct narrower from its category. Narrowers whose
+    options can be ORed contribute that one OR predicate, otherwise each of
+    their options is a separate choice. Narrowers with no options are skipped.
+    """
+
+    containers: dict[str, typing.Type[MultiAndPredicate]] = {
+        'AND': MultiAndPredicate,
+        'OR': MultiOrPredicate
+    }
+
+    def __init__(self, op: str, children: list, categories: dict, default_predicate: typing.Type[BasePredicate]) -> None:
+        super().__init__()
+        self.op: str = op
+        self.children: list = children
+        self.categories: dict = categories
+        self.default_predicate: typing.Type[BasePredicate] = default_predicate
+        self.leaves: list[str] = [*self._walkLeaves(op, children)]
+        self._leaf_options: dict[Narrower, list[BasePredicate]] = {}
+
+    def __repr__(self) -> str:
+        return f"<{type(self).__name__} {self.op} {self.children!r}>"
+
+    def _walkLeaves(self, op: str, children: list) -> typing.Iterator[str]:
+        if op not in self.containers:
+            raise NotImplementedError(op)
+        for child in children:
+            if isinstance(child, dict):
+                for ck, cv in child.items():
+                    yield from self._walkLeaves(ck, cv)
+            elif isinstance(child, str):
+                yield child
+            else:
+                raise NotImplementedError(child.__class__)
+
+    def leafOptions(self, narrower: Narrower) -> list[BasePredicate]:
+        """The predicates a leaf can become when it draws this narrower"""
+        if narrower not in self._leaf_options:
+            predicate_opts = [*narrower.getPredicateOpts()]
+            options = predicate_opts
+            if len(predicate_opts) > 0:
+                try:
+                    or_predicate = MultiOrPredicate(predicate_opts, self.default_predicate)
+                    or_predicate.format()  # verify this doesn't error
+                    options = [or_predicate]
+                except ValueError:
+                    pass
+            self._leaf_options[narrower] = options
+        return self._leaf_options[narrower]
+
+    def candidates(self, category: str) -> list[Narrower]:
+        return [n for n in self.categories[category] if len(self.leafOptions(n)) > 0]
+
+    def _weights(self, narrowers: list[Narrower]) -> list[int]:
+        return [len(self.leafOptions(n)) for n in narrowers]
+
+    def _categoryWeights(self) -> dict[str, list[int]]:
+        return {c: self._weights(self.candidates(c)) for c in self.leaves}
+
+    def count(self) -> int:
+        """The number of arrangements of narrowers and options this pattern has, computed arithmetically
+
+        Arrangements can render the same query when narrowers share tags, so this is an
+        upper bound on distinct queries; distinctQueries counts those.
+        """
+        return _countLeaves(self.leaves, self._categoryWeights())
+
+    def nth(self, index: int) -> BasePredicate:
+        """The index-th query, in the same order as iterAll, decoded without enumeration"""
+        candidates = {c: self.candidates(c) for c in self.leaves}
+        picks = [
+            self.leafOptions(candidates[category][position])[choice]
+            for category, (position, choice) in zip(
+                self.leaves,
+                _decodeLeaves(index, self.leaves, self._categoryWeights())
+            )
+        ]
+        return self._build(self.op, self.children, iter(picks))
+
+    def _build(self, op: str, children: list, picks: typing.Iterator[BasePredicate]) -> BasePredicate:
+        return buildTree(op, children, picks, self.default_predicate)
+
+    def iterAll(self, start: int = 0, stop: typing.Optional[int] = None) -> typing.Iterator[BasePredicate]:
+        total = self.count()
+        stop = total if stop is None else min(stop, total)
+        for index in range(max(0, start), stop):
+            yield self.nth(index)
+
+    def compile(self) -> 'QueryPlan':
+        """Pre-render this pattern into a QueryPlan of literal fragments and slots"""
+        candidates = {c: self.candidates(c) for c in self.leaves}
+
+        # Render the tree once with marker leaves to find the literal text between slots.
+        # Markers subclass the leaf's own class so formatBinOp dispatches exactly as it would.
+        def _placeholder(i: int, category: str) -> BasePredicate:
+            options = [o for n in candidates[category] for o in self.leafOptions(n)]
+            dialects = {type(_leftmost(o)).formatBinOp for o in options}
+            if len(dialects) > 1:
+                raise ValueError("Category mixes predicate dialects", category)
+            # A category without options makes the plan's count() 0; it still renders with the default dialect
+            leaf_kind = type(_leftmost(options[0])) if options else self.default_predicate
+            marker = type('Placeholder', (leaf_kind,), {'format': lambda _self: f"\x00{i}\x00"})
+            return marker.__new__(marker)
+
+        placeholders = (_placeholder(i, c) for i, c in enumerate(self.leaves))
+        rendered = self._build(self.op, self.children, placeholders).format()
+        pieces = re.split('\x00[0-9]+\x00', rendered)
+
+        return QueryPlan(
+            literals=tuple(pieces),
+            slot_categories=tuple(self.leaves),
+            slot_ops=tuple(self._walkOps(self.op, self.children)),
+            names={c: tuple(n.name for n in candidates[c]) for c in candidates},
+            fragments={
+                c: tuple(tuple(o.format() for o in self.leafOptions(n)) for n in candidates[c])
+                for c in candidates
+            },
+            op=self.op,
+            children=self.children,
+            default_predicate=self.default_predicate,
+            options={
+                c: tuple(tuple(self.leafOptions(n)) for n in candidates[c])
+                for c in candidates
+            }
+        )
+
+    def _walkOps(self, op: str, children: list) -> typing.Iterator[str]:
+        """The operator each leaf sits under, in leaf order"""
+        for child in children:
+            if isinstance(child, dict):
+                for ck, cv in child.items():
+                    yield from self._walkOps(ck, cv)
+            else:
+                yield op
+
+
+def buildTree(op: str, children: list, picks: typing.Iterator[BasePredicate], default_predicate: typing.Type[BasePredicate]) -> BasePredicate:
+    """A pattern tree with each leaf replaced by the next pick"""
+    child_items: list[BasePredicate] = []
+    for child in children:
+        if isinstance(child, dict):
+            for ck, cv in child.items():
+                child_items.append(buildTree(ck, cv, picks, default_predicate))
+        else:
+            child_items.append(next(picks))
+    return Pattern.containers[op](child_items, default_predicate)
+
+
+def _leftmost(predicate: BasePredicate) -> BasePredicate:
+    """The atomic predicate whose class decides how a container is formatted"""
+    while isinstance(predicate, PredicateContainer):
+        predicate = next(iter(predicate.all_predicates()))
+    return predicate
+
+
+class QueryPlan():
+    """A pattern flattened into literal text between slots, with every slot option pre-rendered
+
+    Producing a query is just picking an option per slot and joining strings.
+    """
+
+    def __init__(self, literals: tuple[str, ...], slot_categories: tuple[str, ...], slot_ops: tuple[str, ...],
+                 names: dict[str, tuple[str, ...]], fragments: dict[str, tuple[tuple[str, ...], ...]],
+                 op: str, children: list, default_predicate: typing.Type[BasePredicate],
+                 options: dict[str, tuple[tuple[BasePredicate, ...], ...]]) -> None:
+        super().__init__()
+        # The pattern and the predicate behind every fragment, for rebuilding a query's tree
+        self.op: str = op
+        self.children: list = children
+        self.default_predicate: typing.Type[BasePredicate] = default_predicate
+        self.options: dict[str, tuple[tuple[BasePredicate, ...], ...]] = options
+        self.literals: tuple[str, ...] = literals
+        self.slot_categories: tuple[str, ...] = slot_categories
+        self.slot_ops: tuple[str, ...] = slot_ops
+        self.names: dict[str, tuple[str, ...]] = names
+        self.fragments: dict[str, tuple[tuple[str, ...], ...]] = fragments
+        # quote_plus works character by character, so quoting the pieces and joining
+        # them gives exactly quote_plus of the whole query, without re-encoding shared text
+        self.quoted_literals: tuple[str, ...] = tuple(quote_plus(literal) for literal in literals)
+        self.quoted_fragments: dict[str, tuple[tuple[str, ...], ...]] = {
+            c: tuple(tuple(quote_plus(f) for f in frags) for frags in category_frags)
+            for c, category_frags in fragments.items()
+        }
+        self.weights: dict[str, list[int]] = {c: [len(f) for f in frags] for c, frags in fragments.items()}
+        self._pools: dict[str, SamplingPool] = {c: SamplingPool(range(len(frags))) for c, frags in fragments.items()}
+
+    def __repr__(self) -> str:
+        return f"<{type(self).__name__} {self.render(['{' + c + '}' for c in self.slot_categories])!r}>"
+
+    def render(self, slot_fragments: typing.Sequence[str], quoted: bool = False) -> str:
+        """Join slot fragments with the literal text between them
+
+        With quoted, the fragments must come from picksFragments(..., quoted=True), and
+        the result is quote_plus of the query.
+        """
+        literals = self.quoted_literals if quoted else self.literals
+        parts = [literals[0]]
+        for fragment, literal in zip(slot_fragments, literals[1:]):
+            parts.append(fragment)
+            parts.append(literal)
+        return ''.join(parts)
+
+    def count(self) -> int:
+        return _countLeaves(self.slot_categories, self.weights)
+
+    def picksFragments(self, picks: typing.Iterable[tuple[int, int]], quoted: bool = False) -> list[str]:
+        fragments = self.quoted_fragments if quoted else self.fragments
+        return [
+            fragments[category][position][choice]
+            for category, (position, choice) in zip(self.slot_categories, picks)
+        ]
+
+    def picksNames(self, picks: typing.Iterable[tuple[int, int]]) -> list[str]:
         return [
-            MultiAndPredicate(andlist, self.default_constructor).format()[1:-1]
+            self.names[category][position]
+            for category, (position, _) in zip(self.slot_categories, picks)
         ]
 
+    def nth(self, index: int) -> str:
+        return self.render(self.picksFragments(_decodeLeaves(index, self.slot_categories, self.weights)))
+
+    def iterPicks(self) -> typing.Iterator[list[tuple[int, int]]]:
+        """Every set of picks, in nth order, without decoding each index from scratch"""
+        slots = self.slot_categories
+        in_use = {c: [False] * len(w) for c, w in self.weights.items()}
+        picks: list[tuple[int, int]] = [(0, 0)] * len(slots)
+
+        def _fill(i: int) -> typing.Iterator[list[tuple[int, int]]]:
+            if i == len(slots):
+                yield picks[:]
+                return
+            used = in_use[slots[i]]
+            for position, options in enumerate(self.weights[slots[i]]):
+                if not used[position]:
+                    used[position] = True
+                    for choice in range(options):
+                        picks[i] = (position, choice)
+                        yield from _fill(i + 1)
+                    used[position] = False
+        return _fill(0)
+
+    def picksPredicate(self, picks: typing.Iterable[tuple[int, int]]) -> BasePredicate:
+        """The predicate tree a set of picks renders, e.g. to canonicalize it"""
+        leaves = (
+            self.options[category][position][choice]
+            for category, (position, choice) in zip(self.slot_categories, picks)
+        )
+        return buildTree(self.op, self.children, leaves, self.default_predicate)
+
+    def drawPicks(self, rng: typing.Optional[random.Random] = None) -> list[tuple[int, int]]:
+        """Pick a distinct narrower per slot uniformly, then one of its options uniformly"""
+        rng = rng or random  # type: ignore[assignment]
+        pools = self._pools
+        picks: list[tuple[int, int]] = []
+        for category in self.slot_categories:
+            position = pools[category].draw(rng)
+            picks.append((position, rng.randrange(self.weights[category][position])))
+        for pool in pools.values():
+            pool.reset()
+        return picks
+
+    def generate(self, n: int, seed: typing.Optional[int] = None, rng: typing.Optional[random.Random] = None) -> list[str]:
+        """Produce n random queries in one pass, drawn the same way as drawPicks
+
+        Pass either a seed or an explicit rng (e.g. from spawnRandom) to make the output reproducible.
+        """
+        if rng is None:
+            rng = random.Random(seed)
+        return [query for query, _ in self._generate(n, rng)]
+
+    def _generate(self, n: int, rng: random.Random, with_picks: bool = False) -> typing.Iterator[tuple[str, typing.Optional[list[tuple[int, int]]]]]:
+        # Flatten everything the hot loop touches into lists indexed by category number,
+        # and inline the swap-remove draw instead of going through SamplingPool.
+        categories = list(self.fragments)
+        category_index = {c: ci for ci, c in enumerate(categories)}
+        fragments = [self.fragments[c] for c in categories]
+        items = [list(range(len(fragments[ci]))) for ci in range(len(categories))]
+        full_sizes = [len(pool) for pool in items]
+        slots = [(category_index[c], literal) for c, literal in zip(self.slot_categories, self.literals[1:])]
+        first_literal = self.literals[0]
+        rand = rng.random
+
+        for _ in range(n):
+            sizes = full_sizes[:]
+            parts = [first_literal]
+            picks: typing.Optional[list[tuple[int, int]]] = [] if with_picks else None
+            for ci, literal in slots:
+                pool = items[ci]
+                if sizes[ci] == 0:
+                    raise IndexError("No new possibilities to draw")
+                size = sizes[ci] - 1
+                i = int(rand() * (size + 1))
+                pool[i], pool[size] = pool[size], pool[i]
+                sizes[ci] = size
+                position = pool[size]
+                options = fragments[ci][position]
+                choice = int(rand() * len(options)) if len(options) > 1 else 0
+                parts.append(options[choice])
+                parts.append(literal)
+                if picks is not None:
+                    picks.append((position, choice))
+            yield ''.join(parts), picks
+
+
+# Iterations per generateChunk call. Each chunk has its own random substream, so output
+# for a seed is the same however chunks are spread over workers (but changes with this).
+GENERATE_CHUNK: int = 10000
+
+
+# generateChunk arguments after plans: seed, chunk, n, canonical, quoted
+Chunk: typing.TypeAlias = tuple[int, int, int, bool, bool]
+
+# A generated query's iteration index within the seed's output, the query, the (op, name)
+# of every narrower it drew, its fingerprint if canonical, and its quote_plus if quoted
+ChunkResult: typing.TypeAlias = list[tuple[int, str, list[tuple[str, str]], typing.Optional[int], typing.Optional[str]]]
+
+
+def generateChunk(plans: list[list[QueryPlan]], seed: int, chunk: int, n: int,
+                  canonical: bool = False, quoted: bool = False) -> ChunkResult:
+    """Run n random iterations as the chunk-th block of the seed's output
+
+    Each iteration picks one patterns entry and produces a query for each of its plans.
+    With canonical, queries are rendered in canonical form and carry their fingerprint.
+    With quoted, they also carry their URL-encoded form for building search URLs.
+    """
+    rng = spawnRandom(seed, chunk)
+
+    # Decide which pattern each iteration uses up front, then generate each pattern's queries in one batch
+    entry_choices = [rng.randrange(len(plans)) for _ in range(n)]
+    batches = {
+        entry: [plan._generate(tally, rng, with_picks=True) for plan in plans[entry]]
+        for entry, tally in collections.Counter(entry_choices).items()
+    }
+    results: ChunkResult = []
+    for index, entry in enumerate(entry_choices, chunk * GENERATE_CHUNK):
+        for plan, batch in zip(plans[entry], batches[entry]):
+            search, picks = next(batch)
+            assert picks is not None
+            fingerprint = quoted_search = None
+            if canonical:
+                predicate = plan.picksPredicate(picks).canonical()
+                search = predicate.format()
+                fingerprint = fingerprintKey(predicate.canonicalKey())
+                if quoted:
+                    quoted_search = quote_plus(search)
+            elif quoted:
+                quoted_search = plan.render(plan.picksFragments(picks, quoted=True), quoted=True)
+            results.append((index, search, [*zip(plan.slot_ops, plan.picksNames(picks))], fingerprint, quoted_search))
+    return results
+
+
+def runChunks(plans: list[list[QueryPlan]], chunks: typing.Iterable[Chunk],
+              workers: int = 1, unordered: bool = False) -> typing.Iterator[ChunkResult]:
+    """Run generateChunk for each chunk, in-process or across worker processes
+
+    Only a small window of chunks is in flight at once, so chunks may be unbounded
+    and the caller can stop consuming at any point.
+    """
+    if workers <= 1:
+        for chunk in chunks:
+            yield generateChunk(plans, *chunk)
+        return
+
+    import concurrent.futures
+    executor = concurrent.futures.ProcessPoolExecutor(
+        max_workers=workers, initializer=_initWorker, initargs=(plans,)
+    )
+    try:
+        chunks = iter(chunks)
+        pending = collections.deque(executor.submit(_workerChunk, c) for c in itertools.islice(chunks, workers * 2))
+        while pending:
+            if unordered:
+                done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                future = next(iter(done))
+                pending.remove(future)
+            else:
+                future = pending.popleft()
+            pending.extend(executor.submit(_workerChunk, c) for c in itertools.islice(chunks, 1))
+            yield future.result()
+    finally:
+        executor.shutdown(cancel_futures=True)
+
+
+def distinctQueries(plans: list[list[QueryPlan]], canonical: bool = False) -> int:
+    """How many different queries the plans can produce, by listing every one of them
+
+    count() counts arrangements of narrowers, and several arrangements give the same query
+    when narrowers share tags or patterns overlap, or the same meaning with canonical.
+    """
+    seen: set[typing.Union[str, int]] = set()
+    for plan in itertools.chain(*plans):
+        for picks in plan.iterPicks():
+            seen.add(plan.picksPredicate(picks).fingerprint() if canonical else plan.render(plan.picksFragments(picks)))
+    return len(seen)
+
+
+class SeenSet():
+    """Exact record of the queries produced so far"""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self._seen: set[typing.Union[str, int]] = set()
+
+    def __len__(self) -> int:
+        return len(self._seen)
+
+    def add(self, item: typing.Union[str, int]) -> bool:
+        """Record a query or fingerprint, returning whether it's new"""
+        if item in self._seen:
+            return False
+        self._seen.add(item)
+        return True
+
+
+class BloomFilter():
+    """A fixed-size, approximate SeenSet for very large runs
+
+    Never forgets an item, but claims an unseen item was already seen with
+    probability about error_rate once capacity items have been added.
+    """
+
+    def __init__(self, capacity: int, error_rate: float = 0.001) -> None:
+        super().__init__()
+        self.size: int = max(8, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes: int = max(1, round(self.size / capacity * math.log(2)))
+        self.bits: bytearray = bytearray((self.size + 7) // 8)
+        self.count: int = 0
+
+    def __repr__(self) -> str:
+        return f"<{type(self).__name__} {self.count} items, {len(self.bits)} bytes, {self.hashes} hashes>"
+
+    def __len__(self) -> int:
+        return self.count
+
+    def add(self, item: typing.Union[str, int]) -> bool:
+        """Record a query or fingerprint, returning whether it's (probably) new"""
+        data = item.encode() if isinstance(item, str) else item.to_bytes(8, 'big')
+        digest = hashlib.blake2b(data, digest_size=16).digest()
+        # Double hashing: k bit positions from two independent 64-bit halves
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        bits = self.bits
+        new = False
+        for i in range(self.hashes):
+            bit = (h1 + i * h2) % self.size
+            mask = 1 << (bit & 7)
+            if not bits[bit >> 3] & mask:
+                bits[bit >> 3] |= mask
+                new = True
+        if new:
+            self.count += 1
+        return new
+
+
+# Compiled plans, sent once to each worker process by _initWorker
+_worker_plans: typing.Optional[list[list[QueryPlan]]] = None
+
+
+def _initWorker(plans: list[list[QueryPlan]]) -> None:
+    global _worker_plans
+    _worker_plans = plans
+
+
+def _workerChunk(chunk: Chunk) -> ChunkResult:
+    assert _worker_plans is not None
+    return generateChunk(_worker_plans, *chunk)
+
+
 def dumps(obj):
     from io import StringIO
     with StringIO() as sp:
-        yaml.dump(obj, sp)
+        getYaml().dump(obj, sp)
         return sp.getvalue()
 
 
+class LoadedInput(typing.NamedTuple):
+    input_categories: dict[str, typing.Optional[list[Narrower]]]
+    bag_kind: typing.Type[PredicateBag]
+    patterns: list[dict]
+    default_predicate: typing.Type[BasePredicate]
+    # highlightTags(input_categories), precomputed when the input is cached
+    highlights: typing.Optional[dict[str, list[str]]] = None
+    # The input file's content hash, known when the input went through the cache
+    digest: typing.Optional[str] = None
+
+
+def iterInputItems(fp: typing.TextIO) -> typing.Iterator[tuple[typing.Any, typing.Any]]:
+    """Yield the top-level keys and values of an input document one at a time
+
+    Each value's node tree is composed, constructed and dropped before the next
+    one is read, so the whole document is never held as nodes at once.
+    """
+    import ruamel.yaml.events
+
+    stream_yaml = getStreamYaml()
+    constructor, parser = stream_yaml.get_constructor_parser(fp)
+    composer = constructor.composer
+    try:
+        parser.get_event()  # StreamStart
+        if parser.check_event(ruamel.yaml.events.StreamEndEvent):
+            return
+        parser.get_event()  # DocumentStart
+        if not parser.check_event(ruamel.yaml.events.MappingStartEvent):
+            # Not a mapping; there's nothing to stream, so construct it the usual way
+            yield None, constructor.construct_document(composer.compose_node(None, None))
+            return
+        parser.get_event()
+        while not parser.check_event(ruamel.yaml.events.MappingEndEvent):
+            key = constructor.construct_document(composer.compose_node(None, None))
+            value = constructor.construct_document(composer.compose_node(None, None))
+            yield key, value
+    finally:
+        parser.dispose()
+        stream_yaml.reader.reset_reader()
+        stream_yaml.scanner.reset_scanner()
+
+
+def _loadCategory(taglists: typing.Any, default_predicate: typing.Type[BasePredicate], resolved: bool) -> typing.Optional[list[Narrower]]:
+    if resolved:
+        return taglists if isinstance(taglists, list) else None
+    if not isinstance(taglists, dict):
+        return None
+    return [
+        Narrower(key, [
+            default_predicate(sys.intern(tag))
+            if isinstance(tag, str)
+            else tag
+            for tag in taglist
+        ])
+        for key, taglist in taglists.items()
+    ]
+
+
+def readYamlInput(path: str) -> LoadedInput:
+    """Parse an input YAML file into narrowers, converting each category as soon as it's read"""
+    settings: dict[str, typing.Any] = {}
+    input_categories: dict[str, typing.Optional[list[Narrower]]] = {}
+    pending: dict[str, typing.Any] = {}  # values read before default_predicate was known
+
+    def _flush() -> None:
+        resolved = settings.get('type') == "resolved"
+        for key, value in pending.items():
+            input_categories[key] = _loadCategory(value, settings.get('default_predicate'), resolved)  # type: ignore[arg-type]
+        pending.clear()
+
+    with open(path, "r") as fp:
+        for key, value in profiler.iterStage('parse', iterInputItems(fp)):
+            if key in ('type', 'default_predicate', 'bag_kind', 'patterns'):
+                settings[key] = value
+            input_categories[key] = None  # keeps the document's key order
+            pending[key] = value
+            if 'default_predicate' in settings or settings.get('type') == "resolved":
+                with profiler.stage('convert'):
+                    _flush()
+    with profiler.stage('convert'):
+        _flush()
+
+    return LoadedInput(
+        input_categories=input_categories,
+        bag_kind=settings['bag_kind'],
+        patterns=settings['patterns'],
+        default_predicate=settings['default_predicate']
+    )
+
+
+# Declarative input: "dialect" picks the predicate classes by name instead of
+# !!python/name tags, so schema files can be loaded without constructing arbitrary objects.
+DIALECTS: dict[str, tuple[typing.Type[BasePredicate], typing.Type[PredicateBag]]] = {
+    'ao3': (TagPredicateAO3, PredicateBagAO3),
+    'booru': (TagPredicate, PredicateBag),
+}
+
+# Extensions of declarative inputs; anything else is input YAML
+SCHEMA_SUFFIXES: tuple[str, ...] = (".json", ".toml")
+
+# Single-key tag objects, e.g. {"not": "Vriska Serket"}. Any other key k becomes KVPredicateAO3(value, k).
+SCHEMA_PREDICATES: dict[str, typing.Type[BasePredicate]] = {
+    'not': NotPredicateAO3,
+    'site': SitePredicate,
+}
+
+
+def _schemaPredicate(item: typing.Any, default_predicate: typing.Type[BasePredicate]) -> BasePredicate:
+    if isinstance(item, str):
+        return default_predicate(sys.intern(item))
+    if isinstance(item, dict) and len(item) == 1:
+        (key, value), = item.items()
+        if isinstance(value, str):
+            if key == 'tag':
+                return default_predicate(sys.intern(value))
+            if key in SCHEMA_PREDICATES:
+                return SCHEMA_PREDICATES[key](sys.intern(value))
+            return KVPredicateAO3(sys.intern(value), key)
+    raise ValueError("Tags must be strings or single-key objects like {\"not\": \"tag\"}", item)
+
+
+def _predicateSchema(predicate: BasePredicate, default_predicate: typing.Type[BasePredicate]) -> typing.Any:
+    if type(predicate) is default_predicate:
+        return predicate.value
+    if type(predicate) is KVPredicateAO3:
+        return {predicate.key: predicate.value}
+    for key, cls in SCHEMA_PREDICATES.items():
+        if type(predicate) is cls:
+            return {key: predicate.value}
+    raise ValueError("No schema form for predicate", predicate)
+
+
+def _parseJson(path: str) -> typing.Any:
+    try:
+        import orjson
+    except ImportError:
+        import json
+        with open(path, "rb") as fp:
+            return json.load(fp)
+    with open(path, "rb") as fp:
+        return orjson.loads(fp.read())
+
+
+def _parseToml(path: str) -> typing.Any:
+    import tomllib
+    with open(path, "rb") as fp:
+        return tomllib.load(fp)
+
+
+def readSchemaInput(path: str) -> LoadedInput:
+    """Load a declarative JSON or TOML input
+
+        {"dialect": "ao3", "patterns": [{"AND": ["fandom", "theme"]}],
+         "fandom": {"homestuck": ["Homestuck", {"not": "Vriska Serket"}]}, ...}
+    """
+    with profiler.stage('parse'):
+        request = _parseToml(path) if path.endswith(".toml") else _parseJson(path)
+    if not isinstance(request, dict):
+        raise ValueError("Input must be an object", path)
+    try:
+        default_predicate, bag_kind = DIALECTS[request.get('dialect', 'booru')]
+    except KeyError:
+        raise ValueError("Unknown dialect", request['dialect'], [*DIALECTS]) from None
+
+    with profiler.stage('convert'):
+        input_categories = {
+            kind: [
+                Narrower(key, [_schemaPredicate(tag, default_predicate) for tag in taglist])
+                for key, taglist in taglists.items()
+            ] if isinstance(taglists, dict) else None
+            for kind, taglists in request.items()
+        }
+    return LoadedInput(
+        input_categories=input_categories,
+        bag_kind=bag_kind,
+        patterns=request['patterns'],
+        default_predicate=default_predicate
+    )
+
+
+def toSchema(loaded: LoadedInput) -> dict[str, typing.Any]:
+    """The declarative form of a loaded input, for writing as JSON"""
+    for dialect, (default_predicate, bag_kind) in DIALECTS.items():
+        if (loaded.default_predicate, loaded.bag_kind) == (default_predicate, bag_kind):
+            break
+    else:
+        raise ValueError("No schema dialect for", loaded.default_predicate, loaded.bag_kind)
+
+    request: dict[str, typing.Any] = {'dialect': dialect, 'patterns': loaded.patterns}
+    for kind, catlist in loaded.input_categories.items():
+        if catlist is not None:
+            request[kind] = {
+                narrower.name: [_predicateSchema(p, default_predicate) for p in narrower.getPredicateOpts()]
+                for narrower in catlist
+            }
+    return request
+
+
+def readInput(path: str) -> LoadedInput:
+    """Load an input file, picking the format from its extension"""
+    if path.endswith(SCHEMA_SUFFIXES):
+        return readSchemaInput(path)
+    return readYamlInput(path)
+
+
+# Category names of synthetic inputs, after which they're numbered
+SYNTH_CATEGORIES: tuple[str, ...] = ('fandom', 'theme')
+# Keys of synthetic KVPredicateAO3 tags
+SYNTH_KV_KEYS: tuple[str, ...] = ('character', 'relationship', 'freeform')
+SYNTH_SITES: tuple[str, ...] = tuple(f"site{i}.booru.org" for i in range(5))
+
+
+def _zipfSampler(n: int, exponent: float, rng: random.Random) -> typing.Callable[[], int]:
+    """Draws 1..n with probability proportional to k ** -exponent"""
+    cum_weights = list(itertools.accumulate(k ** -exponent for k in range(1, n + 1)))
+    population = range(1, n + 1)
+    return lambda: rng.choices(population, cum_weights=cum_weights)[0]
+
+
+def _synthPattern(rng: random.Random, categories: list[str], ops: tuple[str, ...], depth: int,
+                  room: collections.Counter) -> dict:
+    """A pattern tree nested depth levels deep, cycling through ops from the root down
+
+    room counts the leaves each category can still take, as a query draws a different narrower
+    for every leaf; it must have space for at least depth + 1.
+    """
+    def _leaf() -> str:
+        category = rng.choice([category for category in categories if room[category] > 0])
+        room[category] -= 1
+        return category
+
+    # Every level below needs a leaf, and the last one another
+    children: list = [_leaf() for _ in range(min(rng.randint(1, 2), sum(room.values()) - depth))]
+    children.append(_synthPattern(rng, categories, ops[1:] + ops[:1], depth - 1, room) if depth > 1 else _leaf())
+    return {ops[0]: children}
+
+
+def synthInput(dialect: str = 'ao3', categories: int = 4, narrowers: int = 100, vocabulary: int = 10000,
+               max_options: int = 8, zipf: float = 1.1, patterns: int = 3, depth: int = 2,
+               not_rate: float = 0.0, site_rate: float = 0.0, kv_rate: float = 0.0, seed: int = 0) -> LoadedInput:
+    """A random input for scale testing, the same for the same arguments on any machine
+
+    Patterns never have more leaves than there are narrowers to fill them, so categories * narrowers
+    must be at least depth + 1. Each narrower's number of options and each tag's popularity follow Zipf distributions,
+    so a few tags are shared widely and most narrowers are small. The *_rate arguments are
+    the fraction of tags that become NotPredicateAO3, SitePredicate or KVPredicateAO3 instead.
+    """
+    default_predicate, bag_kind = DIALECTS[dialect]
+    rng = spawnRandom(seed, 'synth')
+    # The booru dialect can only AND tags together
+    ops = ('AND', 'OR') if dialect == 'ao3' else ('AND',)
+    names = [
+        SYNTH_CATEGORIES[i] if i < len(SYNTH_CATEGORIES) else f"category{i}"
+        for i in range(categories)
+    ]
+    option_count = _zipfSampler(max_options, zipf, rng)
+    tag_rank = _zipfSampler(vocabulary, zipf, rng)
+
+    def _synthTag(category: str, rank: int) -> BasePredicate:
+        tag = sys.intern(f"{category.title()} Tag {rank}")
+        kind = rng.random()
+        if kind < not_rate:
+            return NotPredicateAO3(tag)
+        if kind < not_rate + site_rate:
+            return SitePredicate(rng.choice(SYNTH_SITES))
+        if kind < not_rate + site_rate + kv_rate:
+            return KVPredicateAO3(tag, rng.choice(SYNTH_KV_KEYS))
+        return default_predicate(tag)
+
+    width = len(str(narrowers - 1))
+    input_categories: dict[str, typing.Optional[list[Narrower]]] = {
+        category: [
+            # Popular tags can be drawn twice; a narrower lists each once
+            Narrower(f"{category}_{n:0{width}}", [
+                _synthTag(category, rank) for rank in dict.fromkeys(tag_rank() for _ in range(option_count()))
+            ])
+            for n in range(narrowers)
+        ]
+        for category in names
+    }
+    return LoadedInput(
+        input_categories=input_categories,
+        bag_kind=bag_kind,
+        patterns=[
+            _synthPattern(rng, names, ops, depth, collections.Counter(dict.fromkeys(names, narrowers)))
+            for _ in range(patterns)
+        ],
+        default_predicate=default_predicate
+    )
+
+
+def writeSynth(path: typing.Optional[str], loaded: LoadedInput) -> None:
+    """Write a synthetic input as declarative JSON if path ends in .json, else as input YAML
+
+    Writes to stdout if path is None or '-'.
+    """
+    def _write(fp: typing.TextIO) -> None:
+        if path and path.endswith(".json"):
+            import json
+            json.dump(toSchema(loaded), fp, indent=2, ensure_ascii=False)
+            fp.write("\n")
+            return
+        # Settings first, so the streaming loader can convert each category as soon as it's read.
+        # Tags name this module as it's loaded, so inputs written on import load on import too.
+        fp.write(f"default_predicate: !!python/name:{__name__}.{loaded.default_predicate.__name__}\n")
+        fp.write(f"bag_kind: !!python/name:{__name__}.{loaded.bag_kind.__name__}\n\n")
+        yaml = getYaml()
+        yaml.dump({'patterns': loaded.patterns}, fp)
+        for category, catlist in loaded.input_categories.items():
+            fp.write("\n")
+            yaml.dump({category: {
+                narrower.name: [
+                    p.value if type(p) is loaded.default_predicate else p
+                    for p in narrower.getPredicateOpts()
+                ]
+                for narrower in catlist or ()
+            }}, fp)
+
+    if path is None or path == '-':
+        _write(sys.stdout)
+    else:
+        with _atomicWrite(path, "w") as fp:
+            _write(fp)
+
+
+@contextlib.contextmanager
+def _atomicWrite(path: str, mode: str = "w") -> typing.Iterator[typing.IO]:
+    """Write to a temporary file beside path and rename it into place only once complete"""
+    # Per-process name, so concurrent runs never write into each other's temporary file
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(temp_path, mode) as fp:
+            yield fp
+        os.replace(temp_path, path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(temp_path)
+        raise
+
+
+# Bump whenever the pickled layout of LoadedInput or the predicate classes changes
+CACHE_VERSION: int = 5
+
+
+def _fileDigest(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as fp:
+        for block in iter(functools.partial(fp.read, 1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _readCache(path: str, cache_path: str) -> typing.Optional[LoadedInput]:
+    """The cached input, if the cache exists and was built from this exact input file"""
+    try:
+        with open(cache_path, "rb") as fp:
+            # The header is a separate pickle so a stale cache is rejected without loading the payload
+            version, module, source, mtime_ns, size, digest = pickle.load(fp)
+            stat = os.stat(path)
+            if version != CACHE_VERSION or source != os.path.abspath(path) or size != stat.st_size:
+                return None
+            # Classes are pickled by module, so a cache written by `import main` holds main.X,
+            # which isn't __main__.X when run as a script: bag_kind comparisons would silently fail
+            if module != __name__:
+                return None
+            if mtime_ns != stat.st_mtime_ns and digest != _fileDigest(path):
+                return None
+            return pickle.load(fp)
+    except (OSError, EOFError, ValueError, AttributeError, ImportError, pickle.UnpicklingError):
+        return None
+
+
+def _writeCache(path: str, cache_path: str, loaded: LoadedInput) -> None:
+    stat = os.stat(path)
+    header = (CACHE_VERSION, __name__, os.path.abspath(path), stat.st_mtime_ns, stat.st_size, loaded.digest or _fileDigest(path))
+    try:
+        with _atomicWrite(cache_path, "wb") as fp:
+            pickle.dump(header, fp, protocol=pickle.HIGHEST_PROTOCOL)
+            pickle.dump(loaded, fp, protocol=pickle.HIGHEST_PROTOCOL)
+    except OSError:
+        pass  # Caching is best-effort; a read-only directory shouldn't stop the run
+
+
+def loadInput(path: str, cache_path: typing.Optional[str] = None) -> LoadedInput:
+    """Load an input file, going through a compiled pickle cache at cache_path if given
+
+    The cache is used when its recorded path, size and mtime match the input, or when
+    only the mtime differs but the content hash still matches. Declarative inputs are
+    never cached: they're the format that's safe to load from anywhere, and unpickling
+    whatever sits beside them would undo that. They parse about as fast anyway.
+    """
+    if path.endswith(SCHEMA_SUFFIXES):
+        cache_path = None
+    with profiler.stage('read_cache'):
+        loaded = _readCache(path, cache_path) if cache_path else None
+    if loaded is None:
+        loaded = readInput(path)
+        if cache_path:
+            with profiler.stage('write_cache'):
+                loaded = loaded._replace(highlights=highlightTags(loaded.input_categories), digest=_fileDigest(path))
+                _writeCache(path, cache_path, loaded)
+
+    # Predicates don't change after loading, so let them memoize their formatting
+    for catlist in loaded.input_categories.values():
+        for narrower in catlist or ():
+            narrower.freeze()
+    return loaded
+
+
+# Bump whenever the content of a side artifact changes for the same input
+ARTIFACT_VERSION: int = 4
+
+
+def _artifactBuild(header: str, input_digest: str, options: typing.Hashable = None) -> str:
+    return hashlib.sha256(repr((ARTIFACT_VERSION, header, input_digest, options)).encode()).hexdigest()
+
+
+def writeArtifact(path: str, header: str, write: typing.Callable[[typing.TextIO], None]) -> bool:
+    """(Re)write a side artifact unless its first line already records this exact build
+
+    Paths ending in .gz are gzip-compressed. Returns whether the file was written.
+    """
+    import gzip
+    compressed = path.endswith(".gz")
+    try:
+        with (gzip.open(path, "rt") if compressed else open(path, "r")) as fp:
+            if fp.readline() == header:
+                return False
+    except (OSError, EOFError, UnicodeDecodeError):
+        pass
+    if not compressed:
+        with _atomicWrite(path, "w") as fp:
+            fp.write(header)
+            write(fp)
+        return True
+    with _atomicWrite(path, "wb") as raw:
+        # mtime=0 keeps the output identical for identical content
+        with gzip.GzipFile(fileobj=raw, mode="wb", mtime=0) as gz, io.TextIOWrapper(gz, encoding="utf-8") as fp:
+            fp.write(header)
+            write(fp)
+    return True
+
+
+# highlight.css background per category
+CSS_COLORS: dict[str, str] = {
+    'fandom': 'yellow',
+    'theme': 'lightblue'
+}
+CSS_DEFAULT_COLOR: str = 'blue'
+
+
+def _tagValues(predicate: BasePredicate) -> typing.Iterator[str]:
+    if isinstance(predicate, PredicateContainer):
+        for child in predicate.children:
+            yield from _tagValues(child)
+    else:
+        yield predicate.value
+
+
+def highlightTags(input_categories: dict[str, typing.Optional[list[Narrower]]]) -> dict[str, list[str]]:
+    """Every tag to highlight, grouped by color, each listed once
+
+    A tag in several categories gets the color of the last one, which is the rule
+    that won the cascade when every narrower had its own rule.
+    """
+    colors: dict[str, str] = {}
+    for catname, catlist in input_categories.items():
+        color = CSS_COLORS.get(catname, CSS_DEFAULT_COLOR)
+        if isinstance(catlist, list):
+            for narrower in catlist:
+                for predicate in narrower.getPredicateOpts():
+                    for tag in _tagValues(predicate):
+                        # Re-inserting moves the tag to its latest color
+                        colors.pop(tag, None)
+                        colors[tag] = color
+    highlights: dict[str, list[str]] = {}
+    for tag, color in colors.items():
+        highlights.setdefault(color, []).append(tag)
+    return highlights
+
+
+# AO3 replaces these in tag names before URL-encoding them, since they'd break its routes
+AO3_TAG_ESCAPES: dict[str, str] = {
+    '/': '*s*',
+    '&': '*a*',
+    '.': '*d*',
+    '?': '*q*',
+    '#': '*h*',
+}
+_AO3_TAG_ESCAPE_TABLE = str.maketrans(AO3_TAG_ESCAPES)
+
+
+@functools.cache
+def ao3TagHref(tag: str) -> str:
+    """The path segment AO3 links a tag with, as in /tags/<segment>/works
+
+    AO3's escapes first, then percent-encoding of everything not allowed in a path segment.
+
+    >>> ao3TagHref("Kirk/Spock (Star Trek)")
+    'Kirk*s*Spock%20(Star%20Trek)'
+    >>> ao3TagHref("Dr. Who & Pokémon?")
+    'Dr*d*%20Who%20*a*%20Pok%C3%A9mon*q*'
+    """
+    return quote(tag.translate(_AO3_TAG_ESCAPE_TABLE), safe="!$&'()*+,;=:@")
+
+
+def writeCss(fp: typing.TextIO, highlights: dict[str, list[str]], minify: bool = False) -> None:
+    """One rule per color, selecting links to each of its tags"""
+    for color, tags in highlights.items():
+        selectors = [f'[href^="/tags/{ao3TagHref(tag)}"]' for tag in tags]
+        if minify:
+            fp.write(','.join(selectors) + f"{{background:{color}}}")
+        else:
+            fp.write(',\n'.join(selectors) + f" {{ background: {color}; }}\n")
+
+
+class OutputRow(typing.NamedTuple):
+    query: str
+    url: typing.Optional[str]
+    # (op, name) of each narrower the query drew, including _-prefixed ones
+    narrowers: list[tuple[str, str]]
+    # None when enumerating with --stream, where index is the query's position instead of the iteration's
+    seed: typing.Optional[int]
+    index: int
+
+
+def searchUrl(bag_kind: typing.Type[PredicateBag], search: str, quoted: typing.Optional[str] = None) -> typing.Optional[str]:
+    """The site's search URL for a query, if it has one. Pass quoted if quote_plus(search) is already known."""
+    if bag_kind == PredicateBagAO3:
+        return f"https://archiveofourown.org/works/search?work_search%5Bquery%5D={quote_plus(search) if quoted is None else quoted}"
+    return None
+
+
+class Sink():
+    """Writes output rows to a file, buffering them into large batched writes"""
+
+    # Rows held before a flush
+    BUFFER_ROWS: int = 65536
+    # Seconds rows are held before a flush, so output piped to e.g. head arrives as it's made;
+    # None to only flush full buffers
+    FLUSH_SECONDS: typing.Optional[float] = 0.2
+
+    def __init__(self, fp: typing.IO) -> None:
+        super().__init__()
+        import time
+        self.fp: typing.IO = fp
+        self._rows: list[OutputRow] = []
+        self._clock = time.monotonic
+        self._flushed: float = self._clock()
+
+    def __enter__(self) -> 'Sink':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def write(self, row: OutputRow) -> None:
+        self._rows.append(row)
+        if len(self._rows) >= self.BUFFER_ROWS or (
+            self.FLUSH_SECONDS is not None and self._clock() - self._flushed >= self.FLUSH_SECONDS
+        ):
+            self.flush()
+
+    def flush(self) -> None:
+        if self._rows:
+            self._writeRows(self._rows)
+            self._rows = []
+        self.fp.flush()
+        self._flushed = self._clock()
+
+    def close(self) -> None:
+        self.flush()
+
+    def _writeRows(self, rows: list[OutputRow]) -> None:
+        raise NotImplementedError()
+
+
+class TextSink(Sink):
+    """The human-readable format: the query and its URL
+
+    If narrowers is given, the narrowers behind each query are written there as diagnostics,
+    leaving out those whose names start with _, as they're meant to stay out of sight.
+    """
+
+    def __init__(self, fp: typing.IO, narrowers: typing.Optional[typing.TextIO] = None) -> None:
+        super().__init__(fp)
+        self.narrowers: typing.Optional[typing.TextIO] = narrowers
+
+    def _writeRows(self, rows: list[OutputRow]) -> None:
+        parts: list[str] = []
+        for row in rows:
+            parts.append(row.query + "\n")
+            if row.url is not None:
+                parts.append(row.url + "\n\n")
+        self.fp.write(''.join(parts))
+        if self.narrowers is not None:
+            self.narrowers.write(''.join(
+                f"{op} <Narrower {name!r}>\n" for row in rows for op, name in row.narrowers if not name.startswith('_')
+            ))
+
+
+class JsonlSink(Sink):
+    def __init__(self, fp: typing.IO) -> None:
+        super().__init__(fp)
+        import json
+        self._dumps = json.JSONEncoder(ensure_ascii=False).encode
+
+    def _writeRows(self, rows: list[OutputRow]) -> None:
+        dumps = self._dumps
+        self.fp.write(''.join(dumps(row._asdict()) + "\n" for row in rows))
+
+
+class CsvSink(Sink):
+    """One row per query; narrowers are written as space-separated op:name pairs"""
+
+    def __init__(self, fp: typing.IO) -> None:
+        super().__init__(fp)
+        import csv
+        self._writer = csv.writer(fp)
+        self._writer.writerow(OutputRow._fields)
+
+    def _writeRows(self, rows: list[OutputRow]) -> None:
+        self._writer.writerows(
+            (row.query, row.url, ' '.join(f"{op}:{name}" for op, name in row.narrowers), row.seed, row.index)
+            for row in rows
+        )
+
+
+class ParquetSink(Sink):
+    """Each flush becomes one row group. Needs pyarrow."""
+
+    # Small row groups make poor Parquet, so only flush full buffers
+    FLUSH_SECONDS = None
+
+    def __init__(self, fp: typing.IO) -> None:
+        super().__init__(fp)
+        import pyarrow
+        import pyarrow.parquet
+        self._pa = pyarrow
+        self.schema = pyarrow.schema([
+            ('query', pyarrow.string()),
+            ('url', pyarrow.string()),
+            ('narrowers', pyarrow.list_(pyarrow.struct([('op', pyarrow.string()), ('name', pyarrow.string())]))),
+            ('seed', pyarrow.int64()),
+            ('index', pyarrow.int64()),
+        ])
+        self._writer = pyarrow.parquet.ParquetWriter(fp, self.schema)
+
+    def _writeRows(self, rows: list[OutputRow]) -> None:
+        self._writer.write_table(self._pa.Table.from_pydict({
+            'query': [row.query for row in rows],
+            'url': [row.url for row in rows],
+            'narrowers': [[{'op': op, 'name': name} for op, name in row.narrowers] for row in rows],
+            'seed': [row.seed for row in rows],
+            'index': [row.index for row in rows],
+        }, schema=self.schema))
+
+    def close(self) -> None:
+        super().close()
+        self._writer.close()
+
+
+# --format name: (sink class, whether it writes bytes)
+SINKS: dict[str, tuple[typing.Type[Sink], bool]] = {
+    'text': (TextSink, False),
+    'jsonl': (JsonlSink, False),
+    'csv': (CsvSink, False),
+    'parquet': (ParquetSink, True),
+}
+
+
+@contextlib.contextmanager
+def openSink(format: str, path: typing.Optional[str], **kwargs) -> typing.Iterator[Sink]:
+    """A sink of the given --format writing to path, or to stdout if path is None or '-'"""
+    sink_kind, binary = SINKS[format]
+    if path is None or path == '-':
+        fp = sys.stdout.buffer if binary else sys.stdout
+        with sink_kind(fp, **kwargs) as sink:
+            yield sink
+        return
+    with open(path, "wb" if binary else "w", **({} if binary else {'newline': '', 'encoding': 'utf-8'}), buffering=1 << 20) as fp:
+        with sink_kind(fp, **kwargs) as sink:
+            yield sink
+
+
+class StageProfiler():
+    """Wall time, CPU time and traced memory per named stage of a run
+
+    Stages nest: a stage entered inside another is recorded as outer/inner. Memory
+    is only measured if tracemalloc was started, and time spent in worker processes
+    only shows up as the parent's wall time waiting for them.
+    """
+
+    def __init__(self, enabled: bool = True) -> None:
+        super().__init__()
+        import time
+        self.enabled: bool = enabled
+        # name: [calls, wall, cpu, net bytes, peak bytes above the stage's start]
+        self.stages: dict[str, list] = {}
+        self._stack: list[list] = []
+        self._start: tuple[float, float] = (time.perf_counter(), time.process_time())
+        self._peak: int = 0
+
+    def _traced(self) -> tuple[int, int]:
+        import tracemalloc
+        return tracemalloc.get_traced_memory() if tracemalloc.is_tracing() else (0, 0)
+
+    @contextlib.contextmanager
+    def stage(self, name: str) -> typing.Iterator[None]:
+        if not self.enabled:
+            yield
+            return
+        import time
+        import tracemalloc
+        if self._stack:
+            # Resetting the peak below would lose the enclosing stage's peak so far
+            self._stack[-1][1] = max(self._stack[-1][1], self._traced()[1])
+        if tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+        path = '/'.join([*(frame[0] for frame in self._stack), name])
+        # Created on entry so the report lists stages in the order they started
+        stats = self.stages.setdefault(path, [0, 0.0, 0.0, 0, 0])
+        current = self._traced()[0]
+        frame = [name, current]
+        self._stack.append(frame)
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+            self._stack.pop()
+            end, peak = self._traced()
+            peak = max(frame[1], peak)
+            self._peak = max(self._peak, peak)
+            if self._stack:
+                self._stack[-1][1] = max(self._stack[-1][1], peak)
+            stats[0] += 1
+            stats[1] += wall
+            stats[2] += cpu
+            stats[3] += end - current
+            stats[4] = max(stats[4], peak - current)
+
+    def openStages(self) -> list[str]:
+        """Names of the stages currently entered, outermost first"""
+        return [frame[0] for frame in self._stack]
+
+    def iterStage(self, name: str, iterable: typing.Iterable) -> typing.Iterator:
+        """Yield from iterable, timing each step as the named stage"""
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def report(self, fp: typing.TextIO) -> None:
+        """Write a table of the stages, then a total since the profiler was created"""
+        import time
+        current, peak = self._traced()
+        rows = [*self.stages.items(), ('total', [
+            1, time.perf_counter() - self._start[0], time.process_time() - self._start[1],
+            current, max(self._peak, peak)
+        ])]
+        width = max(len(name) for name, _ in rows)
+        fp.write(f"{'stage':<{width}} {'calls':>8} {'wall s':>9} {'cpu s':>9} {'net MiB':>9} {'peak MiB':>9}\n")
+        import tracemalloc
+        tracing = tracemalloc.is_tracing()
+        for name, (calls, wall, cpu, net, peak) in rows:
+            memory = f"{net / 2 ** 20:>9.2f} {peak / 2 ** 20:>9.2f}" if tracing else f"{'-':>9} {'-':>9}"
+            fp.write(f"{name:<{width}} {calls:>8} {wall:>9.3f} {cpu:>9.3f} {memory}\n")
+
+
+# Stages of the current run, recorded when --profile is given
+profiler: StageProfiler = StageProfiler(enabled=False)
+
+
+class SpeedscopeProfiler():
+    """Samples the main thread's stack on a timer into a speedscope sampled profile, for flamegraphs
+
+    Each sample is rooted at the stages open when it was taken, and identical stacks are
+    merged, so the profile grows with the number of distinct stacks rather than the run's
+    length. Worker processes aren't sampled. See https://www.speedscope.app/file-format-schema.json
+    """
+
+    def __init__(self, stages: StageProfiler, interval: float = 0.005) -> None:
+        super().__init__()
+        import threading
+        self.stages: StageProfiler = stages
+        # Seconds between samples
+        self.interval: float = interval
+        self.frames: list[dict[str, typing.Any]] = []
+        # Frame ids of a sampled stack, root first: seconds spent in it
+        self.samples: dict[tuple[int, ...], float] = {}
+        self._frame_ids: dict[typing.Hashable, int] = {}
+        self._stopping = threading.Event()
+        self._thread: typing.Optional[threading.Thread] = None
+        self._thread_id: typing.Optional[int] = None
+        self._start: float = 0.0
+        self._end: float = 0.0
+
+    def _frameId(self, key: typing.Hashable, frame: dict[str, typing.Any]) -> int:
+        frame_id = self._frame_ids.get(key)
+        if frame_id is None:
+            frame_id = self._frame_ids[key] = len(self.frames)
+            self.frames.append(frame)
+        return frame_id
+
+    def _sample(self) -> tuple[int, ...]:
+        stack: list[int] = []
+        frame = sys._current_frames().get(self._thread_id)
+        while frame is not None:
+            code = frame.f_code
+            stack.append(self._frameId(code, {'name': code.co_qualname, 'file': code.co_filename, 'line': code.co_firstlineno}))
+            frame = frame.f_back
+        stack.reverse()
+        return (*(self._frameId(('stage', name), {'name': f"[{name}]"}) for name in self.stages.openStages()), *stack)
+
+    def _run(self) -> None:
+        last = self._clock()
+        while not self._stopping.wait(self.interval):
+            stack = self._sample()
+            now = self._clock()
+            # The time since the last sample goes to the stack seen now
+            self.samples[stack] = self.samples.get(stack, 0.0) + now - last
+            last = now
+
+    def start(self) -> None:
+        import threading
+        import time
+        self._clock = time.perf_counter
+        self._thread_id = threading.get_ident()
+        self._start = self._clock()
+        self._thread = threading.Thread(target=self._run, name="speedscope sampler", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stopping.set()
+        self._thread.join()
+        self._end = self._clock() - self._start
+
+    def write(self, path: str, name: str) -> None:
+        import json
+        with _atomicWrite(path, "w") as fp:
+            json.dump({
+                '$schema': "https://www.speedscope.app/file-format-schema.json",
+                'name': name,
+                'exporter': "searchgenerator",
+                'shared': {'frames': self.frames},
+                'profiles': [{
+                    'type': "sampled",
+                    'name': name,
+                    'unit': "seconds",
+                    'startValue': 0,
+                    'endValue': self._end,
+                    'samples': [list(stack) for stack in self.samples],
+                    'weights': list(self.samples.values()),
+                }],
+            }, fp)
+
+
 def parse_args():
     import argparse
     parser = argparse.ArgumentParser(
@@ -230,155 +1957,320 @@ def parse_args():
     )
 
     parser.add_argument("--input", "-i", default="input.yaml")
-
-    return parser.parse_args()
+    parser.add_argument("--cache", default=None,
+                        help="Compiled input cache file for YAML inputs (default: the input path plus .cache); "
+                             "JSON and TOML inputs are never cached")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="Always parse the input YAML, and don't write a cache")
+    parser.add_argument("--resolved", default="_resolved.yaml",
+                        help="Where to dump the resolved categories (empty to skip)")
+    parser.add_argument("--resolved2", default="_resolved2.yaml",
+                        help="Where to dump every category's tag lists (empty to skip)")
+    parser.add_argument("--css", default="highlight.css",
+                        help="Where to write the tag highlighting userstyle (empty to skip, .gz to compress)")
+    parser.add_argument("--css-minify", action="store_true",
+                        help="Write the userstyle without whitespace")
+    parser.add_argument("--no-artifacts", action="store_true",
+                        help="Don't write any of the side artifacts above")
+    parser.add_argument("--convert-to", default=None, metavar="PATH",
+                        help="Write the input as declarative JSON to PATH, then exit")
+    parser.add_argument("--stream", action="store_true",
+                        help="Lazily enumerate every query the patterns can produce instead of sampling randomly")
+    parser.add_argument("--start", type=int, default=0,
+                        help="With --stream, skip to the start-th query")
+    parser.add_argument("--stop", type=int, default=None,
+                        help="With --stream, stop before the stop-th query")
+    parser.add_argument("--count", "-n", type=int, default=10,
+                        help="How many random queries to generate")
+    parser.add_argument("--seed", type=int, default=None,
+                        help="Seed for reproducible output (default: fresh entropy every run)")
+    parser.add_argument("--workers", "-j", type=int, default=1,
+                        help="Generate random queries in this many processes")
+    parser.add_argument("--unordered", action="store_true",
+                        help="With --workers, emit chunks as they finish instead of in order")
+    parser.add_argument("--unique", action="store_true",
+                        help="Never emit the same query twice; --count is then the number of distinct queries")
+    parser.add_argument("--canonical", action="store_true",
+                        help="Emit queries in canonical form, and with --unique deduplicate them by meaning")
+    parser.add_argument("--exact-limit", type=int, default=1_000_000,
+                        help="With --unique, track queries exactly up to this --count, with a Bloom filter beyond it. "
+                             "If the patterns have at most this many arrangements, they're also listed up front "
+                             "to find exactly how many distinct queries there are")
+    parser.add_argument("--bloom-error", type=float, default=0.001,
+                        help="With --unique, the Bloom filter's false positive rate")
+    parser.add_argument("--max-stall", type=int, default=None,
+                        help="With --unique, give up after this many duplicate draws in a row (default: never "
+                             "when the distinct queries were counted exactly, else 10 times the arrangements)")
+    parser.add_argument("--format", "-f", choices=list(SINKS), default="text",
+                        help="Output format; parquet needs pyarrow")
+    parser.add_argument("--output", "-o", default=None,
+                        help="Write queries to this file instead of stdout")
+    parser.add_argument("--show-narrowers", action="store_true",
+                        help="With the text format, list the narrowers behind each query on stderr")
+    parser.add_argument("--cardinality", action="store_true",
+                        help="Print how many arrangements of narrowers each pattern has, then exit. That's an "
+                             "upper bound on distinct queries: narrowers that share tags, patterns that overlap "
+                             "across entries and --canonical can all make fewer")
+    parser.add_argument("--profile", action="store_true",
+                        help="Print wall time, CPU time and memory (via tracemalloc) per stage to stderr")
+    parser.add_argument("--profile-output", default=None, metavar="PATH",
+                        help="With --profile, also write a cProfile stats file to PATH, or if PATH ends in "
+                             ".speedscope.json, a speedscope profile sampling the stack every 5ms")
+    parser.add_argument("--profile-no-memory", action="store_true",
+                        help="With --profile, skip tracemalloc, which slows allocation-heavy stages a lot")
+
+    subparsers = parser.add_subparsers(dest="command", metavar="COMMAND")
+    synth = subparsers.add_parser(
+        "synth", help="Write a synthetic input for scale testing",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    synth.add_argument("--output", "-o", default=None,
+                       help="Where to write the input; .json for the declarative form, otherwise YAML (default: stdout)")
+    synth.add_argument("--dialect", choices=list(DIALECTS), default="ao3")
+    synth.add_argument("--categories", type=int, default=4)
+    synth.add_argument("--narrowers", type=int, default=100,
+                       help="Narrowers per category")
+    synth.add_argument("--vocabulary", type=int, default=10000,
+                       help="Distinct tags per category to draw from")
+    synth.add_argument("--max-options", type=int, default=8,
+                       help="Most tags a narrower can have")
+    synth.add_argument("--zipf", type=float, default=1.1,
+                       help="Zipf exponent of both options per narrower and tag popularity")
+    synth.add_argument("--patterns", type=int, default=3)
+    synth.add_argument("--depth", type=int, default=2,
+                       help="Nesting depth of each pattern's AND/OR tree")
+    synth.add_argument("--not-rate", type=float, default=None,
+                       help="Fraction of tags that are NotPredicateAO3 (default: 0.05 for ao3, else 0)")
+    synth.add_argument("--site-rate", type=float, default=None,
+                       help="Fraction of tags that are SitePredicate (default: 0.05 for booru, else 0)")
+    synth.add_argument("--kv-rate", type=float, default=None,
+                       help="Fraction of tags that are KVPredicateAO3 (default: 0.02 for ao3, else 0)")
+    synth.add_argument("--seed", type=int, default=0,
+                       help="The same seed always gives the same input")
+
+    args = parser.parse_args()
+    if args.command == 'synth':
+        for name in ('categories', 'narrowers', 'vocabulary', 'max_options', 'patterns', 'depth'):
+            if getattr(args, name) < 1:
+                synth.error(f"--{name.replace('_', '-')} must be at least 1")
+        if args.categories * args.narrowers < args.depth + 1:
+            synth.error(f"--depth {args.depth} patterns need at least {args.depth + 1} narrowers to fill their leaves, "
+                        f"but --categories {args.categories} --narrowers {args.narrowers} only make "
+                        f"{args.categories * args.narrowers}")
+        ao3 = args.dialect == 'ao3'
+        for name, ao3_default, booru_default in [('not_rate', 0.05, 0.0), ('site_rate', 0.0, 0.05), ('kv_rate', 0.02, 0.0)]:
+            if getattr(args, name) is None:
+                setattr(args, name, ao3_default if ao3 else booru_default)
+    if args.format == 'parquet':
+        import importlib.util
+        if importlib.util.find_spec("pyarrow") is None:
+            parser.error("--format parquet needs pyarrow installed")
+        if args.seed is not None and not -2 ** 63 <= args.seed < 2 ** 63:
+            parser.error("--format parquet stores --seed as a 64-bit signed integer")
+    return args
 
 
 def main() -> None:
     args = parse_args()
-
-    with open(args.input, "r") as fp:
-        request = yaml.load(fp)
-
-        def _load(kind) -> typing.Iterable[Narrower]:
-            if not isinstance(request[kind], dict):
-                return
-
-            if request.get("type") == "resolved":
-                return request[kind]
-            return [
-                Narrower(key, [
-                    request['default_predicate'](tag)
-                    if isinstance(tag, str)
-                    else tag
-                    for tag in taglist
-                ])
-                for key, taglist in request[kind].items()
-            ]
-
-        input_categories = {
-            k: _load(k)
-            for k in request.keys()
-        }
-
-        bag_kind = request['bag_kind']
-        patterns = request['patterns']
-        default_predicate = request['default_predicate']
-
-    with open("_resolved.yaml", "w") as fp:
-        yaml.dump({
+    if not args.profile:
+        run(args)
+        return
+
+    import tracemalloc
+    global profiler
+    profiler = StageProfiler()
+    memory = not args.profile_no_memory
+    tracer: typing.Union['cProfile.Profile', SpeedscopeProfiler, None] = None
+    if args.profile_output and args.profile_output.endswith(".speedscope.json"):
+        tracer = SpeedscopeProfiler(profiler)
+    elif args.profile_output:
+        import cProfile
+        tracer = cProfile.Profile()
+    if memory:
+        tracemalloc.start()
+    if isinstance(tracer, SpeedscopeProfiler):
+        tracer.start()
+    elif tracer is not None:
+        tracer.enable()
+    try:
+        run(args)
+    finally:
+        if isinstance(tracer, SpeedscopeProfiler):
+            tracer.stop()
+            tracer.write(args.profile_output, ' '.join(sys.argv))
+        elif tracer is not None:
+            tracer.disable()
+            tracer.dump_stats(args.profile_output)
+        profiler.report(sys.stderr)
+        if memory:
+            tracemalloc.stop()
+
+
+def run(args) -> None:
+    if args.command == 'synth':
+        writeSynth(args.output, synthInput(
+            dialect=args.dialect, categories=args.categories, narrowers=args.narrowers,
+            vocabulary=args.vocabulary, max_options=args.max_options, zipf=args.zipf,
+            patterns=args.patterns, depth=args.depth, not_rate=args.not_rate,
+            site_rate=args.site_rate, kv_rate=args.kv_rate, seed=args.seed
+        ))
+        return
+
+    with profiler.stage('load'):
+        loaded = loadInput(args.input, None if args.no_cache else (args.cache or args.input + ".cache"))
+    input_categories = loaded.input_categories
+    bag_kind = loaded.bag_kind
+    patterns = loaded.patterns
+    default_predicate = loaded.default_predicate
+
+    if args.convert_to:
+        import json
+        with _atomicWrite(args.convert_to, "w") as fp:
+            json.dump(toSchema(loaded), fp, indent=2, ensure_ascii=False)
+            fp.write("\n")
+        return
+
+    def _writeResolved(fp: typing.TextIO) -> None:
+        getYaml().dump({
             "type": "resolved",
             **input_categories
         }, fp)
-    with open("_resolved2.yaml", "w") as fp:
-        yaml.dump({
-            "fandom": {n.name: n.to_input() for n in input_categories['fandom']},
-            "theme": {n.name: n.to_input() for n in input_categories['theme']}
+
+    def _writeResolved2(fp: typing.TextIO) -> None:
+        getYaml().dump({
+            category: {n.name: n.to_input() for n in catlist}
+            for category, catlist in input_categories.items()
+            if catlist is not None
         }, fp)
 
-    with open("highlight.css", 'w') as fp:
-        for catname, catlist in input_categories.items():
-            color = {
-                'fandom': 'yellow',
-                'theme': 'lightblue'
-            }.get(catname, 'blue')
-            if isinstance(catlist, list):
-                for narrower in catlist:
-                    queries = [
-                        # quote(tag.value)
-                        tag.value.replace(' ', '%20')
-                        for tag in
-                        narrower.getPredicateOpts()
-                    ]
-                    if len(queries) > 0:
-                        selector = ', '.join(f'[href^="/tags/{query}"]' for query in queries)
-                        fp.write(f"{selector} {{ background: {color}; }}\n")
-
-    for i in range(10):
-        # bag = bag_kind()
-
-        selected_narrowers = set([None])
-
-        def _readLevel(op, children):
-            nonlocal selected_narrowers
-
-            child_items = []
-            for child in children:
-                if isinstance(child, dict):
-                    for ck, cv in child.items():
-                        child_items.append(_readLevel(ck, cv))
-                elif isinstance(child, str):
-                    # narrower: typing.Optional[Narrower] = None
-                    # while narrower in selected_narrowers:
-                    narrower = random.choice([*set(input_categories[child]) - selected_narrowers])
-                    # print(narrower, selected_narrowers, child)
-                    if not narrower.name.startswith('_'):
-                        print(op, narrower)
-                    predicate_opts = [*narrower.getPredicateOpts()]
-                    if len(predicate_opts) > 0:
-                        selected_narrowers.add(narrower)
-                        try:
-                            or_predicate = MultiOrPredicate(predicate_opts, default_predicate)
-                            or_predicate.format()  # verify this doesn't error
-                            child_items.append(
-                                # narrower
-                                or_predicate
-                            )
-                        except ValueError:
-                            child_items.append(random.choice(predicate_opts))
-                else:
-                    raise NotImplementedError(child.__class__)
-            if op == 'AND':
-                return MultiAndPredicate(child_items, default_predicate)
-            elif op == 'OR':
-                return MultiOrPredicate(child_items, default_predicate)
-            else:
-                raise NotImplementedError(op)
-
-        for k, v in random.choice(patterns).items():
-            search = _readLevel(k, v).format()
-
-            if debug_output:
-                print(repr(search))
-                yaml.dump(search, sys.stdout)
-                print()
-
-            print(search)
-
-            if bag_kind == PredicateBagAO3:
-                query = quote_plus(search)
-                print(f"https://archiveofourown.org/works/search?work_search%5Bquery%5D={query}\n")
-
-            # while k:
-            #     print(k, v)
-            #     if k == 'AND':
-            #         pass
-            #     elif k == 'OR':
-            #         pass
-            #     else:
-            #         k = None
-
-            # bag.addRandom(input_categories[pattern])
-
-        # for narrowers in random.choice([
-        #     (k_theme, k_theme), (k_theme, k_theme),
-        #     (k_theme, k_fandom), (k_theme, k_fandom),
-        #     # (k_theme,),
-        #     # (k_fandom,),
-        # ]):
-        #     bag.addRandom(narrowers)
-
-        # if debug_output:
-        #     print(repr(bag))
-        #     yaml.dump(bag, sys.stdout)
-        #     print()
-            # print(bag.formatRandom())
-
-        # queries: list[str] = [*bag.formatAll()]
-        # random.shuffle(queries)
-        # print('\n'.join(queries[:5]))
-
-    # yaml.dump(yaml.load(dumps(bag)), sys.stdout)
+    def _writeCss(fp: typing.TextIO) -> None:
+        # The cache carries the grouped tags, so a cached run doesn't walk the categories again
+        writeCss(fp, loaded.highlights or highlightTags(input_categories), args.css_minify)
+
+    artifacts = [
+        (args.resolved, "# build: {}\n", _writeResolved, None),
+        (args.resolved2, "# build: {}\n", _writeResolved2, None),
+        (args.css, "/* build: {} */\n", _writeCss, args.css_minify),
+    ]
+    if not args.no_artifacts and any(path for path, _, _, _ in artifacts):
+        with profiler.stage('artifacts'):
+            # A cached load already hashed the input, so only hash it here on a miss
+            input_digest = loaded.digest or _fileDigest(args.input)
+            for path, header, write, options in artifacts:
+                if path:
+                    writeArtifact(path, header.format(_artifactBuild(header, input_digest, options)), write)
+
+    def _emit(sink: Sink, search: str, quoted: typing.Optional[str],
+              narrowers: list[tuple[str, str]], seed: typing.Optional[int], index: int) -> None:
+        if debug_output:
+            print(repr(search), file=sys.stderr)
+            getYaml().dump(search, sys.stderr)
+            print(file=sys.stderr)
+
+        sink.write(OutputRow(search, searchUrl(bag_kind, search, quoted), narrowers, seed, index))
+
+    # Compile every pattern once; generating a query is then just picking and joining fragments
+    with profiler.stage('compile'):
+        plans: list[list[QueryPlan]] = [
+            [Pattern(k, v, input_categories, default_predicate).compile() for k, v in pattern.items()]
+            for pattern in patterns
+        ]
+
+    if args.cardinality:
+        for plan in itertools.chain(*plans):
+            print(plan.count(), plan)
+        print(sum(plan.count() for plan in itertools.chain(*plans)), "total")
+        return
+
+    # Every slot draws a distinct narrower, so a pattern with more slots for a category than
+    # it has usable narrowers can't produce anything. Drop it rather than fail every draw.
+    for plan in itertools.chain(*plans):
+        if plan.count() == 0:
+            print(f"Skipping {plan!r}: it has more slots than some category has narrowers", file=sys.stderr)
+    plans = [entry for entry in ([plan for plan in entry if plan.count() > 0] for entry in plans) if entry]
+    if not plans:
+        return
+
+    sink_options = {'narrowers': sys.stderr} if args.show_narrowers and args.format == 'text' else {}
+
+    # Only AO3 queries have search URLs, so only they need URL-encoding
+    with_urls = bag_kind == PredicateBagAO3
+
+    if args.stream:
+        # Exhaustive, lazy enumeration: nothing is materialized beyond the current query
+        offset = 0
+        with openSink(args.format, args.output, **sink_options) as sink, profiler.stage('enumerate'):
+            for plan in itertools.chain(*plans):
+                total = plan.count()
+                stop = total if args.stop is None else min(total, args.stop - offset)
+                for index in range(max(0, args.start - offset), stop):
+                    picks = _decodeLeaves(index, plan.slot_categories, plan.weights)
+                    narrowers = [*zip(plan.slot_ops, plan.picksNames(picks))]
+                    quoted = plan.render(plan.picksFragments(picks, quoted=True), quoted=True) if with_urls else None
+                    _emit(sink, plan.render(plan.picksFragments(picks)), quoted, narrowers, None, offset + index)
+                offset += total
+        return
+
+    # Fresh seeds fit in an int64, like the seed column of Parquet output
+    seed = args.seed if args.seed is not None else random.SystemRandom().randrange(2 ** 63)
+    seen: typing.Union[SeenSet, BloomFilter, None] = None
+    target: typing.Optional[int] = None
+    max_stall: typing.Optional[int] = None
+    if args.unique:
+        # --count is then a number of distinct queries, which can't exceed the whole space.
+        # count() counts arrangements, which is only an upper bound on distinct queries, so
+        # when there are few enough, list them all to know exactly when the run is done.
+        space = sum(plan.count() for plan in itertools.chain(*plans))
+        exact = space <= args.exact_limit
+        max_stall = args.max_stall
+        if exact:
+            with profiler.stage('distinct'):
+                space = distinctQueries(plans, args.canonical)
+        elif max_stall is None:
+            # With r distinct queries left, a new one takes about space / r draws
+            max_stall = 10 * space
+        target = min(args.count, space)
+        if args.count > space:
+            print(f"Only {space} distinct queries are possible" if exact else
+                  f"At most {space} distinct queries are possible", file=sys.stderr)
+        if target == 0:
+            return
+        seen = SeenSet() if target <= args.exact_limit else BloomFilter(target, args.bloom_error)
+        chunks: typing.Iterable[Chunk] = (
+            (seed, chunk, GENERATE_CHUNK, args.canonical, with_urls) for chunk in itertools.count()
+        )
+    else:
+        chunks = [
+            (seed, chunk, min(GENERATE_CHUNK, args.count - start), args.canonical, with_urls)
+            for chunk, start in enumerate(range(0, args.count, GENERATE_CHUNK))
+        ]
+
+    emitted = rejected = stalled = 0
+    with openSink(args.format, args.output, **sink_options) as sink:
+        for result in profiler.iterStage('generate', runChunks(plans, chunks, args.workers, args.unordered)):
+            with profiler.stage('output'):
+                for index, search, narrowers, fingerprint, quoted in result:
+                    if seen is not None and not seen.add(search if fingerprint is None else fingerprint):
+                        rejected += 1
+                        stalled += 1
+                        if max_stall is not None and stalled > max_stall:
+                            break
+                        continue
+                    stalled = 0
+                    _emit(sink, search, quoted, narrowers, seed, index)
+                    emitted += 1
+                    if emitted == target:
+                        break
+            if emitted == target or (max_stall is not None and stalled > max_stall):
+                break
+        with profiler.stage('output'):
+            sink.flush()
+
+    if seen is not None:
+        print(f"Emitted {emitted} unique queries, rejected {rejected} duplicate draws", file=sys.stderr)
+        if emitted < target:
+            print(f"Warning: gave up after {stalled} duplicate draws in a row; "
+                  f"there may be fewer than {target} distinct queries", file=sys.stderr)
 
 
 if __name__ == "__main__":
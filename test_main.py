@@ -0,0 +1,754 @@
+"""Quick correctness checks for main. Run with `python -m unittest` or pytest; timings live in benchmarks.py."""
+import doctest
+import importlib.util
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import typing
+import unittest
+from unittest import mock
+from urllib.parse import quote_plus
+
+import main
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Tags that exercise every class of character quote_plus treats specially
+AWKWARD_TAGS = [
+    "Pokémon", "Tom & Jerry", "C++", "100% Fluff", "f/f", "Q&A?", "#tag", "a+b=c",
+    "Ünïcödé 日本語", "emoji 🙂", "semi;colon", "tilde~dash-under_score.dot",
+]
+
+
+# Narrowers sharing tags: AND of two distinct fandoms has 10 arrangements, but only
+# 4 distinct queries, and 3 distinct meanings once "t1 t1" is just "t1"
+OVERLAPPING = {
+    'dialect': 'booru',
+    'patterns': [{'AND': ['fandom', 'fandom']}],
+    'fandom': {'x': ['t1'], 'y': ['t2'], 'z': ['t1', 't2']},
+}
+
+
+def runMain(*args: str, artifacts: bool = False) -> subprocess.CompletedProcess:
+    """Run main.py as a script, without a cache, and unless asked for, without side artifacts"""
+    return subprocess.run(
+        [sys.executable, os.path.join(HERE, "main.py"), "--no-cache", *([] if artifacts else ["--no-artifacts"]), *args],
+        check=True, capture_output=True, text=True
+    )
+
+
+def writeInput(directory: str, request: dict) -> str:
+    """Write a declarative input into directory, returning its path"""
+    path = os.path.join(directory, "input.json")
+    with open(path, "w", encoding="utf-8") as fp:
+        json.dump(request, fp)
+    return path
+
+
+# Tags name classes through `main`, as the tests import it, rather than the __main__ a script run sees
+YAML_INPUT = """\
+default_predicate: !!python/name:main.TagPredicate
+bag_kind: !!python/name:main.PredicateBag
+patterns:
+- AND: [fandom, theme]
+fandom:
+  f0: [F0]
+  f1: [F1a, F1b]
+theme:
+  t0: [T0]
+  _t1: [T1a, T1b]
+"""
+
+
+def writeYamlInput(directory: str, text: str = YAML_INPUT) -> str:
+    path = os.path.join(directory, "input.yaml")
+    with open(path, "w", encoding="utf-8") as fp:
+        fp.write(text)
+    return path
+
+
+def plansOf(loaded: main.LoadedInput) -> list:
+    """A loaded input's patterns compiled the way run() does"""
+    return [
+        [main.Pattern(k, v, loaded.input_categories, loaded.default_predicate).compile() for k, v in pattern.items()]
+        for pattern in loaded.patterns
+    ]
+
+
+def queries(loaded: main.LoadedInput) -> list:
+    """Every query a loaded input's patterns can produce, in --stream order"""
+    return [plan.nth(index) for entry in plansOf(loaded) for plan in entry for index in range(plan.count())]
+
+
+def booruCategories() -> dict:
+    """Booru narrowers with uneven numbers of options; booru can't OR, so each option is a separate choice"""
+    return {
+        'fandom': [
+            main.Narrower("f0", [main.TagPredicate("F0")]),
+            main.Narrower("f1", [main.TagPredicate("F1a"), main.TagPredicate("F1b"), main.TagPredicate("F1c")]),
+            main.Narrower("f2", [main.TagPredicate("F2a"), main.TagPredicate("F2b")]),
+        ],
+        'theme': [
+            main.Narrower("t0", [main.TagPredicate("T0a"), main.TagPredicate("T0b")]),
+            main.Narrower("t1", [main.TagPredicate("T1")]),
+            main.Narrower("_t2", [main.TagPredicate("T2")]),
+        ],
+    }
+
+
+def bruteLeaves(leaves: list, weights: dict) -> list:
+    """Every way to fill leaves with distinct narrowers, in the lexicographic order nth uses"""
+    def fill(i: int, used: frozenset) -> typing.Iterator[list]:
+        if i == len(leaves):
+            yield []
+            return
+        for position, options in enumerate(weights[leaves[i]]):
+            if (leaves[i], position) not in used:
+                for option in range(options):
+                    for rest in fill(i + 1, used | {(leaves[i], position)}):
+                        yield [(position, option), *rest]
+    return [*fill(0, frozenset())]
+
+
+class CountNthTest(unittest.TestCase):
+    def test_bag_nth_matches_iterAll(self) -> None:
+        bag = main.PredicateBag()
+        for narrower in booruCategories()['fandom']:
+            bag.addNarrower(narrower)
+        queries = bag.formatAll()
+        self.assertEqual(bag.count(), len(queries))
+        self.assertEqual([bag.nth(i) for i in range(bag.count())], queries)
+        self.assertEqual([*bag.iterAll(2, 5)], queries[2:5])
+        with self.assertRaises(IndexError):
+            bag.nth(bag.count())
+
+    def test_decode_matches_brute_force(self) -> None:
+        for leaves, weights in [
+            (['a', 'b', 'a'], {'a': [1, 3, 2], 'b': [2, 2]}),
+            (['a', 'a', 'a'], {'a': [2, 2, 2, 2]}),
+            (['a', 'b'], {'a': [1], 'b': [4, 1, 2]}),
+        ]:
+            with self.subTest(leaves=leaves, weights=weights):
+                expected = bruteLeaves(leaves, weights)
+                self.assertEqual(main._countLeaves(leaves, weights), len(expected))
+                self.assertEqual([main._decodeLeaves(i, leaves, weights) for i in range(len(expected))], expected)
+                with self.assertRaises(IndexError):
+                    main._decodeLeaves(len(expected), leaves, weights)
+
+    def test_pattern_count_matches_enumeration(self) -> None:
+        pattern = main.Pattern('AND', ['fandom', 'theme', 'fandom'], booruCategories(), main.TagPredicate)
+        queries = [query.format() for query in pattern.iterAll()]
+        self.assertEqual(pattern.count(), len(queries))
+        # Two distinct fandom narrowers: 2! * (1*3 + 1*2 + 3*2) ways; one of the 2 + 1 + 1 theme options
+        self.assertEqual(pattern.count(), 22 * 4)
+        # The same tag can't come from the same narrower twice
+        self.assertNotIn("F0 T1 F0", queries)
+        self.assertEqual(pattern.nth(7).format(), queries[7])
+
+
+class MemoizedFormatTest(unittest.TestCase):
+    def test_reassigning_key_or_value(self) -> None:
+        kv = main.KVPredicateAO3("Rose Lalonde", "character").freeze()
+        self.assertEqual(kv.format(), 'character:"Rose Lalonde"')
+        kv.key = "relationship"
+        self.assertEqual(kv.format(), 'relationship:"Rose Lalonde"')
+        kv.value = "Kanaya Maryam"
+        self.assertEqual(kv.format(), 'relationship:"Kanaya Maryam"')
+
+    def test_container_sees_child_changes(self) -> None:
+        kv = main.KVPredicateAO3("Rose Lalonde", "character")
+        tag = main.TagPredicateAO3("Fluff")
+        tree = main.MultiAndPredicate(
+            ["Homestuck", main.MultiOrPredicate([tag, kv], main.TagPredicateAO3)], main.TagPredicateAO3
+        ).freeze()
+        self.assertEqual(tree.format(), '(tag:"Homestuck" AND (tag:"Fluff" OR character:"Rose Lalonde"))')
+        kv.key = "freeform"
+        self.assertEqual(tree.format(), '(tag:"Homestuck" AND (tag:"Fluff" OR freeform:"Rose Lalonde"))')
+        tag.value = "Angst"
+        self.assertEqual(tree.format(), '(tag:"Homestuck" AND (tag:"Angst" OR freeform:"Rose Lalonde"))')
+
+    def test_invalidation_is_per_instance(self) -> None:
+        kept, changed = main.TagPredicateAO3("Fluff").freeze(), main.TagPredicateAO3("Angst").freeze()
+        kept.format()
+        cached = kept._format_cache
+        changed.value = "Hurt/Comfort"
+        self.assertEqual(changed.format(), 'tag:"Hurt/Comfort"')
+        self.assertIs(kept._format_cache, cached)
+
+
+class QueryPlanTest(unittest.TestCase):
+    def patterns(self) -> list:
+        """Booru and AO3 patterns, flat and nested"""
+        ao3 = main.loadInput(os.path.join(HERE, "input_example_ao3.json"))
+        return [
+            main.Pattern('AND', ['fandom', 'theme', 'fandom'], booruCategories(), main.TagPredicate),
+            *(main.Pattern(k, v, ao3.input_categories, ao3.default_predicate) for pattern in ao3.patterns for k, v in pattern.items()),
+            main.Pattern('AND', ['fandom', {'OR': ['theme', {'AND': ['theme', 'fandom']}]}], ao3.input_categories, ao3.default_predicate),
+        ]
+
+    def test_plan_matches_tree(self) -> None:
+        for pattern in self.patterns():
+            plan = pattern.compile()
+            with self.subTest(pattern=pattern):
+                self.assertEqual(plan.count(), pattern.count())
+                for index in range(plan.count()):
+                    tree = pattern.nth(index).format()
+                    self.assertEqual(plan.nth(index), tree)
+                    picks = main._decodeLeaves(index, plan.slot_categories, plan.weights)
+                    self.assertEqual(plan.picksPredicate(picks).format(), tree)
+
+
+class UnsatisfiablePatternTest(unittest.TestCase):
+    REQUEST = {
+        'dialect': 'booru',
+        'patterns': [{'AND': ['fandom', 'fandom', 'fandom']}, {'AND': ['fandom', 'theme']}],
+        'fandom': {'a': ['A'], 'b': ['B1', 'B2']},
+        'theme': {'t': ['T']},
+    }
+
+    def test_compiles_to_nothing(self) -> None:
+        # Four slots, but only three fandom narrowers
+        plan = main.Pattern('AND', ['fandom'] * 4, booruCategories(), main.TagPredicate).compile()
+        self.assertEqual(plan.count(), 0)
+        with self.assertRaises(IndexError):
+            plan.nth(0)
+
+    def test_run_skips_it(self) -> None:
+        with tempfile.TemporaryDirectory() as tmp:
+            path = writeInput(tmp, self.REQUEST)
+            cardinality = runMain("-i", path, "--cardinality").stdout.splitlines()
+            self.assertEqual(cardinality[0].split()[0], "0")
+            self.assertEqual(cardinality[-1], "3 total")
+            run = runMain("-i", path, "-n", "20", "--seed", "0")
+        self.assertIn("Skipping", run.stderr)
+        self.assertEqual(set(run.stdout.splitlines()), {"A T", "B1 T", "B2 T"})
+
+
+class UniqueTest(unittest.TestCase):
+    def test_iterPicks_in_nth_order(self) -> None:
+        plan = main.Pattern('AND', ['fandom', 'theme', 'fandom'], booruCategories(), main.TagPredicate).compile()
+        self.assertEqual(
+            [*plan.iterPicks()],
+            [main._decodeLeaves(i, plan.slot_categories, plan.weights) for i in range(plan.count())]
+        )
+
+    def test_seen_sets(self) -> None:
+        for seen in (main.SeenSet(), main.BloomFilter(10_000)):
+            with self.subTest(seen=seen):
+                self.assertTrue(seen.add("tag:\"Fluff\""))
+                self.assertFalse(seen.add("tag:\"Fluff\""))
+                self.assertTrue(seen.add(12345))
+                self.assertFalse(seen.add(12345))
+                self.assertEqual(len(seen), 2)
+
+    def test_bloom_error_rate(self) -> None:
+        bloom = main.BloomFilter(10_000, error_rate=0.01)
+        for i in range(10_000):
+            bloom.add(f"query {i}")
+        self.assertTrue(all(not bloom.add(f"query {i}") for i in range(10_000)))
+        # Each probe is added too, so keep them few enough not to overfill the filter
+        false_positives = sum(not bloom.add(f"other {i}") for i in range(1_000))
+        self.assertLess(false_positives, 30)
+
+    def test_distinct_queries(self) -> None:
+        with tempfile.TemporaryDirectory() as tmp:
+            plans = plansOf(main.readInput(writeInput(tmp, OVERLAPPING)))
+        self.assertEqual(sum(plan.count() for entry in plans for plan in entry), 10)
+        self.assertEqual(main.distinctQueries(plans), 4)
+        self.assertEqual(main.distinctQueries(plans, canonical=True), 3)
+
+    def test_exact_run_stops_at_the_space(self) -> None:
+        path = os.path.join(HERE, "input_example_booru.json")
+        run = runMain("-i", path, "--unique", "-n", "1000000", "--seed", "0")
+        lines = run.stdout.splitlines()
+        self.assertEqual(len(lines), len(set(lines)))
+        self.assertEqual(len(lines), main.distinctQueries(plansOf(main.loadInput(path))))
+        self.assertNotIn("Warning", run.stderr)
+
+    def test_bloom_run(self) -> None:
+        path = os.path.join(HERE, "input_example_booru.json")
+        lines = runMain("-i", path, "--unique", "-n", "50", "--exact-limit", "0", "--seed", "0").stdout.splitlines()
+        self.assertEqual(len(set(lines)), 50)
+        with tempfile.TemporaryDirectory() as tmp:
+            # Ten arrangements but four distinct queries, and --exact-limit 0 stops them being listed
+            run = runMain("-i", writeInput(tmp, OVERLAPPING), "--unique", "-n", "10", "--exact-limit", "0")
+        self.assertEqual(set(run.stdout.splitlines()), {"t1 t2", "t1 t1", "t2 t1", "t2 t2"})
+        self.assertIn("Warning: gave up", run.stderr)
+
+
+class CanonicalTest(unittest.TestCase):
+    def tree(self, value: list, kind: type = main.MultiAndPredicate) -> main.BasePredicate:
+        return kind(value, main.TagPredicateAO3)
+
+    def test_order_nesting_and_duplicates(self) -> None:
+        flat = self.tree(["A", "B", "C"])
+        for same in [
+            self.tree(["C", "A", "B"]),
+            self.tree(["A", self.tree(["B", "C"])]),
+            self.tree(["B", "A", "C", "A"]),
+        ]:
+            with self.subTest(same=same):
+                self.assertEqual(same.canonical().canonicalKey(), flat.canonical().canonicalKey())
+                self.assertEqual(same.fingerprint(), flat.fingerprint())
+                self.assertEqual(same.canonical().format(), '(tag:"A" AND tag:"B" AND tag:"C")')
+
+    def test_different_meanings(self) -> None:
+        flat = self.tree(["A", "B", "C"])
+        for different in [
+            self.tree(["A", "B", "C"], main.MultiOrPredicate),
+            self.tree(["A", self.tree(["B", "C"], main.MultiOrPredicate)]),
+            self.tree(["A", "B", main.NotPredicateAO3("C")]),
+            self.tree(["A", "B", main.KVPredicateAO3("C", "character")]),
+        ]:
+            with self.subTest(different=different):
+                self.assertNotEqual(different.fingerprint(), flat.fingerprint())
+
+    def test_single_child_collapses(self) -> None:
+        self.assertEqual(self.tree(["A", "A"]).canonical().format(), 'tag:"A"')
+
+    def test_run_stops_at_distinct_meanings(self) -> None:
+        with tempfile.TemporaryDirectory() as tmp:
+            run = runMain("-i", writeInput(tmp, OVERLAPPING), "--unique", "--canonical", "-n", "100", "--seed", "0")
+        self.assertEqual(sorted(run.stdout.splitlines()), ["t1", "t1 t2", "t2"])
+        self.assertIn("Only 3 distinct queries are possible", run.stderr)
+        self.assertNotIn("Warning", run.stderr)
+
+
+class SamplingTest(unittest.TestCase):
+    def test_pool_draws_each_item_once(self) -> None:
+        pool = main.SamplingPool(range(20))
+        rng = main.spawnRandom(0)
+        for _ in range(3):
+            self.assertEqual(sorted(pool.draw(rng) for _ in range(20)), [*range(20)])
+            with self.assertRaises(IndexError):
+                pool.draw(rng)
+            pool.reset()
+
+    def test_bag_addRandom_without_replacement(self) -> None:
+        fandoms = booruCategories()['fandom']
+        bag = main.PredicateBag()
+        rng = main.spawnRandom(0)
+        for _ in range(2):
+            for _ in range(len(fandoms)):
+                bag.addRandom(fandoms, rng)
+            self.assertCountEqual(bag.narrowers, fandoms)
+            with self.assertRaises(IndexError):
+                bag.addRandom(fandoms, rng)
+            bag.clear()
+
+    def test_plan_draws_distinct_narrowers(self) -> None:
+        plan = main.Pattern('AND', ['fandom', 'fandom', 'fandom', 'theme'], booruCategories(), main.TagPredicate).compile()
+        rng = main.spawnRandom(0)
+        drawn = [plan.drawPicks(rng) for _ in range(200)] + [picks for _, picks in plan._generate(200, rng, with_picks=True)]
+        for picks in drawn:
+            self.assertEqual(len({position for position, _ in picks[:3]}), 3)
+        # Every narrower and option turns up
+        self.assertEqual({tuple(picks[0]) for picks in drawn}, {(0, 0), (1, 0), (1, 1), (1, 2), (2, 0), (2, 1)})
+
+
+class SeedTest(unittest.TestCase):
+    def plans(self) -> list:
+        return [[main.Pattern('AND', ['fandom', 'theme', 'fandom'], booruCategories(), main.TagPredicate).compile()]]
+
+    def test_same_seed_same_queries(self) -> None:
+        plan, = self.plans()[0]
+        self.assertEqual(plan.generate(50, seed=1), self.plans()[0][0].generate(50, seed=1))
+        self.assertNotEqual(plan.generate(50, seed=1), plan.generate(50, seed=2))
+        self.assertEqual(main.generateChunk(self.plans(), 7, 3, 100), main.generateChunk(self.plans(), 7, 3, 100))
+        self.assertNotEqual(main.generateChunk(self.plans(), 7, 3, 100), main.generateChunk(self.plans(), 7, 4, 100))
+
+    def test_substreams(self) -> None:
+        self.assertEqual(main.spawnRandom(5, 1).random(), main.spawnRandoms(5, 3)[1].random())
+        self.assertNotEqual(main.spawnRandom(5, 1).random(), main.spawnRandom(5, 2).random())
+
+    def test_seeded_runs_repeat(self) -> None:
+        path = os.path.join(HERE, "input_example_ao3.json")
+        first = runMain("-i", path, "-n", "100", "--seed", "42").stdout
+        self.assertEqual(runMain("-i", path, "-n", "100", "--seed", "42").stdout, first)
+        self.assertNotEqual(runMain("-i", path, "-n", "100", "--seed", "43").stdout, first)
+
+
+class WorkersTest(unittest.TestCase):
+    # Spans several GENERATE_CHUNK blocks, so workers really do share the run
+    QUERIES = str(2 * main.GENERATE_CHUNK + 500)
+
+    def test_workers_match_one_process(self) -> None:
+        path = os.path.join(HERE, "input_example_booru.json")
+        single = runMain("-i", path, "-n", self.QUERIES, "--seed", "3", "-f", "jsonl").stdout
+        self.assertEqual(runMain("-i", path, "-n", self.QUERIES, "--seed", "3", "-f", "jsonl", "-j", "3").stdout, single)
+        unordered = runMain("-i", path, "-n", self.QUERIES, "--seed", "3", "-f", "jsonl", "-j", "3", "--unordered").stdout
+        self.assertCountEqual(unordered.splitlines(), single.splitlines())
+
+    def test_runChunks_in_process_matches_pool(self) -> None:
+        plans = [[main.Pattern('AND', ['fandom', 'theme'], booruCategories(), main.TagPredicate).compile()]]
+        chunks = [(9, chunk, 100, False, False) for chunk in range(5)]
+        self.assertEqual([*main.runChunks(plans, chunks, workers=2)], [*main.runChunks(plans, chunks)])
+
+
+class SynthTest(unittest.TestCase):
+    def test_same_seed_same_bytes(self) -> None:
+        with tempfile.TemporaryDirectory() as tmp:
+            for suffix in (".json", ".yaml"):
+                outputs = []
+                for name, seed in (("a", "7"), ("b", "7"), ("c", "8")):
+                    path = os.path.join(tmp, name + suffix)
+                    runMain("synth", "--seed", seed, "--narrowers", "20", "--kv-rate", "0.2", "-o", path)
+                    with open(path, "rb") as fp:
+                        outputs.append(fp.read())
+                with self.subTest(suffix=suffix):
+                    self.assertEqual(outputs[0], outputs[1])
+                    self.assertNotEqual(outputs[0], outputs[2])
+
+    def test_small_inputs_are_satisfiable(self) -> None:
+        for dialect in main.DIALECTS:
+            for categories, narrowers, depth in ((1, 2, 1), (1, 4, 3), (2, 2, 3), (4, 1, 3), (3, 2, 5)):
+                loaded = main.synthInput(dialect, categories=categories, narrowers=narrowers,
+                                         depth=depth, patterns=5, seed=depth)
+                with self.subTest(dialect=dialect, categories=categories, narrowers=narrowers, depth=depth):
+                    for entry in plansOf(loaded):
+                        for plan in entry:
+                            self.assertGreater(plan.count(), 0)
+
+    def test_rejects_unfillable_depth(self) -> None:
+        result = subprocess.run([sys.executable, os.path.join(HERE, "main.py"), "synth",
+                                 "--categories", "1", "--narrowers", "2", "--depth", "3"],
+                                capture_output=True, text=True)
+        self.assertEqual(result.returncode, 2)
+        self.assertIn("--depth 3", result.stderr)
+
+
+class CacheTest(unittest.TestCase):
+    def setUp(self) -> None:
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = writeYamlInput(tmp.name)
+        self.cache_path = self.path + ".cache"
+        self.expected = main.toSchema(main.loadInput(self.path, self.cache_path))
+
+    def cached(self) -> typing.Optional[main.LoadedInput]:
+        return main._readCache(self.path, self.cache_path)
+
+    def test_hit(self) -> None:
+        loaded = self.cached()
+        self.assertIsNotNone(loaded)
+        self.assertEqual(main.toSchema(loaded), self.expected)
+        self.assertIsNotNone(loaded.highlights)
+
+    def test_touched_but_unchanged(self) -> None:
+        stat = os.stat(self.path)
+        os.utime(self.path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        self.assertIsNotNone(self.cached())
+
+    def test_edited(self) -> None:
+        stat = os.stat(self.path)
+        # Same size, so only the content hash can tell
+        writeYamlInput(os.path.dirname(self.path), YAML_INPUT.replace("F0", "G0"))
+        os.utime(self.path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        self.assertIsNone(self.cached())
+        loaded = main.loadInput(self.path, self.cache_path)
+        self.assertEqual(loaded.input_categories['fandom'][0].predicate_opts[0].value, "G0")
+        self.assertIsNotNone(self.cached())
+
+    def test_other_version_or_module(self) -> None:
+        with mock.patch.object(main, 'CACHE_VERSION', main.CACHE_VERSION + 1):
+            self.assertIsNone(self.cached())
+        with mock.patch.object(main, '__name__', '__main__'):
+            self.assertIsNone(self.cached())
+
+    def test_hit_knows_the_digest(self) -> None:
+        digest = main._fileDigest(self.path)
+        with mock.patch.object(main, '_fileDigest', side_effect=AssertionError("hashed on a cache hit")):
+            self.assertEqual(main.loadInput(self.path, self.cache_path).digest, digest)
+
+    def test_corrupt(self) -> None:
+        with open(self.cache_path, "r+b") as fp:
+            fp.truncate(os.path.getsize(self.cache_path) // 2)
+        self.assertIsNone(self.cached())
+
+
+class SchemaInputTest(unittest.TestCase):
+    REQUEST = {
+        'dialect': 'ao3',
+        'patterns': [{'AND': ['fandom', {'OR': ['theme', 'theme']}]}],
+        'fandom': {'homestuck': ['Homestuck', {'not': 'Vriska Serket'}]},
+        'theme': {'fluff': ['Fluff', {'character': 'Rose Lalonde'}], 'angst': [{'tag': 'Angst'}]},
+    }
+    TOML = """\
+dialect = "ao3"
+patterns = [{AND = ["fandom", {OR = ["theme", "theme"]}]}]
+
+[fandom]
+homestuck = ["Homestuck", {not = "Vriska Serket"}]
+
+[theme]
+fluff = ["Fluff", {character = "Rose Lalonde"}]
+angst = [{tag = "Angst"}]
+"""
+
+    def test_predicates(self) -> None:
+        with tempfile.TemporaryDirectory() as tmp:
+            loaded = main.readInput(writeInput(tmp, self.REQUEST))
+        self.assertIs(loaded.bag_kind, main.PredicateBagAO3)
+        homestuck, = loaded.input_categories['fandom']
+        self.assertEqual([type(p) for p in homestuck.predicate_opts], [main.TagPredicateAO3, main.NotPredicateAO3])
+        fluff, angst = loaded.input_categories['theme']
+        self.assertEqual(fluff.predicate_opts[1].format(), 'character:"Rose Lalonde"')
+        self.assertIs(type(angst.predicate_opts[0]), main.TagPredicateAO3)
+        with tempfile.TemporaryDirectory() as tmp:
+            with self.assertRaises(ValueError):
+                main.readInput(writeInput(tmp, {**self.REQUEST, 'theme': {'bad': [{'a': 'b', 'c': 'd'}]}}))
+
+    def test_toml_matches_json(self) -> None:
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "input.toml")
+            with open(path, "w", encoding="utf-8") as fp:
+                fp.write(self.TOML)
+            toml = main.toSchema(main.readInput(path))
+            json_ = main.toSchema(main.readInput(writeInput(tmp, self.REQUEST)))
+        self.assertEqual(toml, json_)
+
+    def test_round_trip(self) -> None:
+        with tempfile.TemporaryDirectory() as tmp:
+            converted = main.toSchema(main.readInput(writeInput(tmp, self.REQUEST)))
+            self.assertEqual(main.toSchema(main.readInput(writeInput(tmp, converted))), converted)
+            # Converting a YAML input gives one that produces the same queries
+            from_yaml = main.readInput(writeYamlInput(tmp))
+            from_json = main.readInput(writeInput(tmp, main.toSchema(from_yaml)))
+        self.assertEqual(queries(from_json), queries(from_yaml))
+
+    def test_never_cached(self) -> None:
+        with tempfile.TemporaryDirectory() as tmp:
+            path = writeInput(tmp, self.REQUEST)
+            cache_path = path + ".cache"
+            main.loadInput(path, cache_path)
+            self.assertFalse(os.path.exists(cache_path))
+            # A cache planted beside the input isn't unpickled
+            main._writeCache(path, cache_path, main.readInput(path)._replace(patterns=[]))
+            self.assertEqual(main.loadInput(path, cache_path).patterns, self.REQUEST['patterns'])
+
+
+class StreamingLoaderTest(unittest.TestCase):
+    def assertMatchesFullLoad(self, text: str) -> None:
+        with tempfile.TemporaryDirectory() as tmp:
+            path = writeYamlInput(tmp, text)
+            streamed = main.readYamlInput(path)
+            with open(path) as fp:
+                document = main.getYaml().load(fp)
+        self.assertIs(streamed.default_predicate, document['default_predicate'])
+        self.assertIs(streamed.bag_kind, document['bag_kind'])
+        self.assertEqual(streamed.patterns, document['patterns'])
+        self.assertEqual([*streamed.input_categories], [*document])
+        for category in ('fandom', 'theme'):
+            self.assertEqual(
+                {n.name: [p.value for p in n.predicate_opts] for n in streamed.input_categories[category]},
+                document[category]
+            )
+
+    def test_settings_first(self) -> None:
+        self.assertMatchesFullLoad(YAML_INPUT)
+
+    def test_settings_last(self) -> None:
+        # Categories read before default_predicate wait until it turns up
+        settings, categories = YAML_INPUT.split("fandom:\n", 1)
+        self.assertMatchesFullLoad("fandom:\n" + categories + settings)
+
+
+class ArtifactsTest(unittest.TestCase):
+    def test_resolved2_lists_every_category(self) -> None:
+        request = {
+            'dialect': 'booru', 'patterns': [{'AND': ['artist', 'medium']}],
+            'artist': {'a': ['A1', 'A2']}, 'medium': {'m': ['M']},
+        }
+        with tempfile.TemporaryDirectory() as tmp:
+            resolved2 = os.path.join(tmp, "_resolved2.yaml")
+            runMain("-i", writeInput(tmp, request), "-n", "1",
+                    "--resolved", "", "--css", "", "--resolved2", resolved2, artifacts=True)
+            with open(resolved2, encoding="utf-8") as fp:
+                fp.readline()  # build header
+                self.assertEqual(main.getYaml().load(fp), {'artist': {'a': ['A1', 'A2']}, 'medium': {'m': ['M']}})
+
+
+class CssTest(unittest.TestCase):
+    REQUEST = {
+        'dialect': 'ao3', 'patterns': [{'AND': ['fandom', 'theme', 'warning']}],
+        'fandom': {'a': ['Shared', 'Kirk/Spock'], 'b': ['Shared']},
+        'theme': {'t': ['Angst', 'Shared']},
+        'warning': {'w': ['Angst']},
+    }
+
+    def highlights(self) -> dict:
+        with tempfile.TemporaryDirectory() as tmp:
+            return main.highlightTags(main.readInput(writeInput(tmp, self.REQUEST)).input_categories)
+
+    def test_grouping_last_category_wins(self) -> None:
+        self.assertEqual(self.highlights(), {
+            'yellow': ['Kirk/Spock'],
+            'lightblue': ['Shared'],
+            main.CSS_DEFAULT_COLOR: ['Angst'],
+        })
+
+    def test_minify(self) -> None:
+        highlights = {'yellow': ['Kirk/Spock', 'Angst']}
+        pretty, minified = io.StringIO(), io.StringIO()
+        main.writeCss(pretty, highlights)
+        main.writeCss(minified, highlights, minify=True)
+        self.assertEqual(pretty.getvalue(),
+                         '[href^="/tags/Kirk*s*Spock"],\n[href^="/tags/Angst"] { background: yellow; }\n')
+        self.assertEqual(minified.getvalue(), '[href^="/tags/Kirk*s*Spock"],[href^="/tags/Angst"]{background:yellow}')
+
+    def test_gzip_artifact(self) -> None:
+        import gzip
+        highlights = self.highlights()
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "highlight.css.gz")
+            write = lambda fp: main.writeCss(fp, highlights)
+            self.assertTrue(main.writeArtifact(path, "/* build 1 */\n", write))
+            with open(path, "rb") as fp:
+                first = fp.read()
+            with gzip.open(path, "rt", encoding="utf-8") as fp:
+                self.assertEqual(fp.readline(), "/* build 1 */\n")
+                self.assertIn("background: lightblue;", fp.read())
+            # Same build: left alone
+            self.assertFalse(main.writeArtifact(path, "/* build 1 */\n", write))
+            # A rebuild of the same content is byte-identical
+            os.remove(path)
+            self.assertTrue(main.writeArtifact(path, "/* build 1 */\n", write))
+            with open(path, "rb") as fp:
+                self.assertEqual(fp.read(), first)
+
+
+class QuotedPlanTest(unittest.TestCase):
+    def plans(self) -> list:
+        """Plans over the AO3 example plus a pattern of awkward tags"""
+        loaded = main.loadInput(os.path.join(HERE, "input_example_ao3.json"))
+        categories = {
+            **loaded.input_categories,
+            'awkward': [
+                main.Narrower(f"awkward{i}", [main.TagPredicateAO3(tag)])
+                for i, tag in enumerate(AWKWARD_TAGS)
+            ] + [main.Narrower("awkward_or", [main.TagPredicateAO3(tag) for tag in AWKWARD_TAGS[:3]])]
+        }
+        patterns = [*loaded.patterns, {'AND': ['awkward', {'OR': ['awkward', 'awkward']}]}]
+        return [
+            main.Pattern(k, v, categories, loaded.default_predicate).compile()
+            for pattern in patterns for k, v in pattern.items()
+        ]
+
+    def test_matches_quote_plus(self) -> None:
+        for plan in self.plans():
+            for index in range(plan.count()):
+                picks = main._decodeLeaves(index, plan.slot_categories, plan.weights)
+                search = plan.render(plan.picksFragments(picks))
+                self.assertEqual(plan.render(plan.picksFragments(picks, quoted=True), quoted=True), quote_plus(search))
+
+
+class SinkTest(unittest.TestCase):
+    ROWS = [
+        main.OutputRow("a AND b", "https://example.org/?q=a", [("AND", "a"), ("AND", "_b")], 7, 0),
+        main.OutputRow("c", None, [("NOT", "c")], 7, 1),
+    ]
+
+    def writeAll(self, sink: main.Sink) -> None:
+        with sink:
+            for row in self.ROWS:
+                sink.write(row)
+
+    def test_text(self) -> None:
+        out, narrowers = io.StringIO(), io.StringIO()
+        self.writeAll(main.TextSink(out, narrowers))
+        self.assertEqual(out.getvalue(), "a AND b\nhttps://example.org/?q=a\n\nc\n")
+        # Hidden narrowers stay out of the diagnostics
+        self.assertEqual(narrowers.getvalue(), "AND <Narrower 'a'>\nNOT <Narrower 'c'>\n")
+
+    def test_jsonl_keeps_every_narrower(self) -> None:
+        out = io.StringIO()
+        self.writeAll(main.JsonlSink(out))
+        rows = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual(rows[0]["narrowers"], [["AND", "a"], ["AND", "_b"]])
+        self.assertEqual([row["index"] for row in rows], [0, 1])
+        self.assertIsNone(rows[1]["url"])
+
+    def test_csv(self) -> None:
+        import csv
+        out = io.StringIO()
+        self.writeAll(main.CsvSink(out))
+        rows = list(csv.reader(io.StringIO(out.getvalue())))
+        self.assertEqual(rows[0], list(main.OutputRow._fields))
+        self.assertEqual(rows[1], ["a AND b", "https://example.org/?q=a", "AND:a AND:_b", "7", "0"])
+
+    def test_flushes_on_timer(self) -> None:
+        out = io.StringIO()
+        sink = main.TextSink(out)
+        sink.write(self.ROWS[0])
+        self.assertEqual(out.getvalue(), "")
+        with mock.patch.object(sink, "_clock", return_value=sink._flushed + sink.FLUSH_SECONDS + 1):
+            sink.write(self.ROWS[1])
+        self.assertEqual(out.getvalue(), "a AND b\nhttps://example.org/?q=a\n\nc\n")
+
+    @unittest.skipIf(importlib.util.find_spec("pyarrow") is None, "needs pyarrow")
+    def test_parquet_large_seed(self) -> None:
+        import pyarrow.parquet
+        out = io.BytesIO()
+        seed = 2 ** 63 - 1
+        with main.ParquetSink(out) as sink:
+            sink.write(self.ROWS[0]._replace(seed=seed))
+        out.seek(0)
+        table = pyarrow.parquet.read_table(out)
+        self.assertEqual(table.column("seed").to_pylist(), [seed])
+        self.assertEqual(table.column("narrowers").to_pylist()[0][1], {"op": "AND", "name": "_b"})
+
+
+def _spin(seconds: float) -> None:
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+
+class SpeedscopeProfilerTest(unittest.TestCase):
+    def test_sampled_profile(self) -> None:
+        stages = main.StageProfiler()
+        sampler = main.SpeedscopeProfiler(stages, interval=0.001)
+        sampler.start()
+        with stages.stage("outer"), stages.stage("busy"):
+            _spin(0.2)
+        sampler.stop()
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "run.speedscope.json")
+            sampler.write(path, "test")
+            with open(path, encoding="utf-8") as fp:
+                document = json.load(fp)
+        profile = document["profiles"][0]
+        self.assertEqual(profile["type"], "sampled")
+        self.assertEqual(len(profile["samples"]), len(profile["weights"]))
+        self.assertLessEqual(sum(profile["weights"]), profile["endValue"])
+        names = [[document["shared"]["frames"][i]["name"] for i in stack] for stack in profile["samples"]]
+        spinning = [stack for stack in names if "_spin" in stack]
+        self.assertTrue(spinning)
+        for stack in spinning:
+            self.assertEqual(stack[:2], ["[outer]", "[busy]"])
+        # Identical stacks are merged into one weighted sample
+        self.assertEqual(len(set(map(tuple, names))), len(names))
+
+
+class AO3TagHrefTest(unittest.TestCase):
+    def test_golden(self) -> None:
+        """ao3_tag_hrefs.tsv lists tags and the path segment AO3 links each with"""
+        with open(os.path.join(HERE, "ao3_tag_hrefs.tsv"), encoding="utf-8") as fp:
+            for line in fp:
+                if line.startswith("#") or not line.strip():
+                    continue
+                tag, expected = line.rstrip("\n").split("\t")
+                with self.subTest(tag=tag):
+                    self.assertEqual(main.ao3TagHref(tag), expected)
+
+    def test_doctests(self) -> None:
+        """main's docstring examples, e.g. ao3TagHref's"""
+        self.assertEqual(doctest.testmod(main).failed, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()